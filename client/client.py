@@ -1,4 +1,6 @@
 import time
+import random
+import argparse
 import http.client
 import json
 import threading
@@ -23,6 +25,11 @@ def log_response_debug_info(response):
     client_logger.info("Response body: {}".format(response.read()))
 
 
+def report_throttled_request(response):
+    if response.status in (429, 503): # Too Many Requests or Service Unavailable
+        print("Server is busy, please retry in {} s".format(response.getheader("Retry-After")))
+
+
 def _log_chat_state(manager):
     if isinstance(manager, ConsoleChatStateManager):
         client_logger.info("Console Chat state: {")
@@ -32,35 +39,69 @@ def _log_chat_state(manager):
     client_logger.info("}")
     
 
-def update_one_of_chat_states(connection, state_manager):
-    headers = dict() 
-    if isinstance(state_manager, ConsoleChatStateManager):
-        client_logger.info("Updating Actions state")
-        headers={"Get-Chat-Actions": "true"}
-    if isinstance(state_manager, FileChatStateManager):
-        client_logger.info("Updating File Chat state")
-        headers={"Get-Chat-State": "true"}
-    connection.request("GET", url="/", headers=headers)
-    new_state = json.loads(connection.getresponse().read().decode("utf-8"))
-    state_manager.UpdateState(new_state)
-    _log_chat_state(state_manager)
+# ui.txt shows the newest messages: one page of them, then the actions made after it
+def load_file_chat_state(connection):
+    client_logger.info("Loading File Chat state")
+    connection.request("GET", url="/", headers={"Get-Chat-Size": "true"})
+    messages_count = json.loads(connection.getresponse().read().decode("utf-8"))["messages"]
+    first_id = max(messages_count - file_chat_state_manager.messages_count, 0)
+    connection.request("GET", url="/", headers={
+        "Get-Chat-Page": "true", "Page-Start": str(first_id), "Page-Size": str(file_chat_state_manager.messages_count)})
+    response = connection.getresponse()
+    page = json.loads(response.read().decode("utf-8"))
+    file_chat_state_manager.LoadPage(page, int(response.getheader("Chat-Actions")))
+    _log_chat_state(file_chat_state_manager)
+
+
+# Downloads only the actions that the console or ui.txt have not seen yet
+def update_chat_states(connection):
+    global next_action_id
+    from_action_id = min(next_action_id, file_chat_state_manager.next_action_id)
+    client_logger.info("Updating chat states from action {}".format(from_action_id))
+    connection.request("GET", url="/", headers={"Get-Chat-Actions": "true", "From-Action-ID": str(from_action_id)})
+    new_actions = json.loads(connection.getresponse().read().decode("utf-8"))
+    unseen_actions = [action for action in new_actions if action["id"] >= next_action_id]
+    if len(unseen_actions) > 0:
+        console_chat_state_manager.AddActions(unseen_actions)
+        next_action_id = unseen_actions[-1]["id"] + 1
+    file_chat_state_manager.ApplyActions(new_actions)
 
 
 lock = threading.Lock()
+# Returned by the server on sign in, writes and read cursor requests must carry it
+session = None
+# Last action id the server knows we have seen and the first action id we have not downloaded yet.
+# Both are set after sign in by suggest_and_load_unseen_actions.
+acknowledged_action_id = None
+next_action_id = None
+
+
+def acknowledge_seen_actions(connection):
+    global acknowledged_action_id
+    last_action_id = next_action_id - 1
+    if last_action_id <= acknowledged_action_id:
+        return
+    client_logger.info("Acknowledging actions up to {}".format(last_action_id))
+    connection.request("POST", url="/",  headers={"Ack-Actions": "true", "Action-ID": str(last_action_id), "Session": session})
+    response = connection.getresponse()
+    log_response_debug_info(response)
+    if response.status == 200:
+        acknowledged_action_id = last_action_id
 
 
-def update_chat_states_thread_safe(connection):
-    lock.acquire()
-    update_one_of_chat_states(connection, file_chat_state_manager)
-    update_one_of_chat_states(connection, console_chat_state_manager)
-    lock.release()
+def update_chat_states_thread_safe(poll_connection):
+    with lock:
+        update_chat_states(poll_connection)
+        acknowledge_seen_actions(connection) # read cursors are kept by the primary
 
 
 def sign_in(connection, login, password):
+    global session
     connection.request("POST", url="/",  headers={"Auth": "true", "Login": login, "Password": password})
     response = connection.getresponse() 
     log_response_debug_info(response) 
     if response.status == 200:
+        session = response.getheader("Session")
         print("Sign in OK.")
         return True
     if response.status == 401:
@@ -78,36 +119,53 @@ def sign_up(connection, login, password):
     if response.status == 400:
         print("Could not sign up: login {} is already used".format(login)) 
         return False
+    report_throttled_request(response)
+    return False
 
 
 def send_message(connection, message_text):
     logging.info("Sending message: {}".format(message_text)) 
-    connection.request("POST", url="/",  headers={"Send-Message": "true"}, body=message_text) 
+    connection.request("POST", url="/",  headers={"Send-Message": "true", "Session": session}, body=message_text) 
     response = connection.getresponse() 
     log_response_debug_info(response) 
+    report_throttled_request(response)
 
 
 def send_comment(connection, message_id, comment_text):
     logging.info("Sending comment to message_id {}: {}".format(message_id, comment_text)) 
-    connection.request("POST", url="/",  headers={"Comment": "true", "Message-ID": message_id}, body=comment_text) 
+    connection.request("POST", url="/",  headers={"Comment": "true", "Message-ID": message_id, "Session": session}, body=comment_text) 
     response = connection.getresponse()
     log_response_debug_info(response) 
+    report_throttled_request(response)
 
 
 def send_reaction(connection, message_id, reaction):
     logging.info("Sending reaction to message_id {}: {}".format(message_id, reaction)) 
-    connection.request("POST", url="/",  headers={"Reaction": reaction, "Message-ID": message_id}) 
+    connection.request("POST", url="/",  headers={"Reaction": reaction, "Message-ID": message_id, "Session": session}) 
     response = connection.getresponse()
     log_response_debug_info(response) 
-
-
-def suggest_and_load_last_actions(n_last):
-    command = None
-    while command not in ('y', 'n'): 
-        print("Load last {} actions? Enter 'y' for 'yes' and 'n' for 'no'".format(n_last))
-        command = input()
-    if command == 'y':
-        console_chat_state_manager.LoadLast(n_last)
+    report_throttled_request(response)
+
+
+def suggest_and_load_unseen_actions(connection):
+    global acknowledged_action_id, next_action_id
+    with lock:
+        connection.request("GET", url="/",  headers={"Get-Unseen-Actions": "true", "Session": session})
+        unseen = json.loads(connection.getresponse().read().decode("utf-8"))
+    unread = unseen["unread"]
+    print("You have {} unseen actions: {} mentions and {} replies to your messages".format(
+        unread["unread"], unread["mentions"], unread["replies"]))
+
+    if unread["unread"] > 0:
+        command = None
+        while command not in ('y', 'n'): 
+            print("Load unseen actions? Enter 'y' for 'yes' and 'n' for 'no'")
+            command = input()
+        if command == 'y':
+            console_chat_state_manager.AddActions(unseen["actions"])
+    with lock:
+        acknowledged_action_id = unread["cursor"]
+        next_action_id = unread["cursor"] + 1 + len(unseen["actions"])
 
 
 def read_login_password():
@@ -119,6 +177,12 @@ def read_login_password():
 
 
 def parse_command_and_execute(connection, command):
+    with lock:
+        send_command(connection, command)
+    update_chat_states_thread_safe(poll_connection)
+
+
+def send_command(connection, command):
     if not command.startswith("/"):
         send_message(connection, command)
     else:
@@ -145,20 +209,32 @@ def parse_command_and_execute(connection, command):
                 return
             send_reaction(connection, message_id=message_id, reaction=command_code_to_reaction[command_code])
 
-    update_chat_states_thread_safe(connection)
-
-connection = http.client.HTTPConnection(host="localhost", port=19000, timeout=10)
+parser = argparse.ArgumentParser(description="Comment-Reaction Chat client")
+parser.add_argument("--host", default="localhost", help="Address of the primary server")
+parser.add_argument("--port", type=int, default=19000, help="Port of the primary server")
+parser.add_argument(
+    "--replica",
+    action="append",
+    default=[],
+    help="host:port of a read replica to poll instead of the primary, may be given several times",
+)
+args = parser.parse_args()
+
+connection = http.client.HTTPConnection(host=args.host, port=args.port, timeout=10)
+
+# Writes always go to the primary, polls may be spread over read replicas
+if len(args.replica) > 0:
+    replica_host, replica_port = random.choice(args.replica).rsplit(":", 1)
+    poll_connection = http.client.HTTPConnection(host=replica_host, port=int(replica_port), timeout=10)
+else:
+    poll_connection = connection
 
 def worker_chat_update(sleep_time):
     while True:
-        update_chat_states_thread_safe(connection) 
+        update_chat_states_thread_safe(poll_connection) 
         time.sleep(sleep_time)
 
 
-thread_chat_update = threading.Thread(target=worker_chat_update, args=(0.5,))
-thread_chat_update.start()
-
-
 """ USER CLI LOGIC """
 
 print(""" - - - Comment-Reaction Chat - - -
@@ -169,17 +245,24 @@ if input() == 's':
     sign_up_ok = False
     while not sign_up_ok:
         login, password = read_login_password()
-        sign_up_ok = sign_up(connection, login, password)
+        with lock:
+            sign_up_ok = sign_up(connection, login, password)
 
 print("Please, SIGN IN.")
 sign_in_ok = False
 while not sign_in_ok:
     login, password = read_login_password()
-    sign_in_ok = sign_in(connection, login, password)
+    with lock:
+        sign_in_ok = sign_in(connection, login, password)
 
 print("Welcome to Comment-Reaction Chat!")
-n_last_messages_to_suggest = 10
-suggest_and_load_last_actions(n_last_messages_to_suggest)
+suggest_and_load_unseen_actions(connection)
+with lock:
+    load_file_chat_state(poll_connection)
+
+# Polling starts once we know which actions have been seen
+thread_chat_update = threading.Thread(target=worker_chat_update, args=(0.5,))
+thread_chat_update.start()
 
 print("--- Now you can start typing ---")
 while True:
@@ -187,4 +270,5 @@ while True:
     parse_command_and_execute(connection, command)
 
 connection.close()
+poll_connection.close()
 
@@ -0,0 +1,338 @@
+"""
+Headless asyncio client for Comment-Reaction Chat, for bots and bridges.
+
+    transport = ChatTransport("localhost", 19000)
+    client = AsyncChatClient(transport)
+    await client.SignIn("login", "password")
+    await client.SendMessage("Hi there")
+    async for action in client.Subscribe():
+        ...
+
+Many clients can share one ChatTransport: the server tells sessions apart by the
+Session header, so their requests are pipelined over a few keep-alive connections,
+and their subscriptions are served by one Get-Chat-Actions poll per transport.
+"""
+
+import json
+import asyncio
+import logging
+import itertools
+from collections import deque
+
+class ChatRequestError(Exception):
+    def __init__(self, status, reason, retry_after=None):
+        super().__init__("Request failed with {} {}".format(status, reason))
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ChatResponse:
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers # lower-cased header names
+        self.body = body
+
+
+    def Text(self):
+        return self.body.decode("utf-8")
+
+
+    def Json(self):
+        return json.loads(self.Text())
+
+
+# One keep-alive HTTP/1.1 connection. Requests are written as soon as they are made
+# and responses are matched to them in order, so many requests can be in flight at once.
+class PipelinedConnection:
+    def __init__(self, host, port, logger, timeout=10):
+        self.host = host
+        self.port = port
+        self.logger = logger
+        self.timeout = timeout
+        self.writer = None
+        self.pending = None
+        self.write_lock = asyncio.Lock()
+
+
+    async def Request(self, method, headers, body=b""):
+        request = self._EncodeRequest(method, headers, body)
+        async with self.write_lock:
+            if self.writer is None:
+                await self._Connect()
+            writer, pending = self.writer, self.pending
+            response = asyncio.get_running_loop().create_future()
+            pending.append(response)
+            writer.write(request)
+            try:
+                await writer.drain()
+            except OSError:
+                self._Disconnect(writer, pending)
+        try:
+            return await asyncio.wait_for(response, self.timeout)
+        except asyncio.TimeoutError:
+            # A half-open connection never answers, and the responses queued behind this one would not either
+            self.logger.info("Request to {}:{} timed out".format(self.host, self.port))
+            self._Disconnect(writer, pending)
+            raise
+
+
+    async def Close(self):
+        if self.writer is not None:
+            writer = self.writer
+            self._Disconnect(self.writer, self.pending)
+            await writer.wait_closed()
+
+
+    async def _Connect(self):
+        self.logger.info("Connecting to {}:{}".format(self.host, self.port))
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        # Every connection gets its own queue, so a dying connection fails only its own requests
+        self.pending = deque()
+        asyncio.get_running_loop().create_task(self._ReadResponses(reader, self.writer, self.pending))
+
+
+    def _Disconnect(self, writer, pending):
+        if self.writer is writer:
+            self.writer = None
+        writer.close()
+        while len(pending) > 0:
+            response = pending.popleft()
+            if not response.done():
+                response.set_exception(ConnectionResetError("Connection to {}:{} was lost".format(self.host, self.port)))
+
+
+    async def _ReadResponses(self, reader, writer, pending):
+        try:
+            while True:
+                response = await self._ReadResponse(reader)
+                if len(pending) == 0:
+                    break
+                future = pending.popleft()
+                if not future.done():
+                    future.set_result(response)
+                if response.headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, OSError, ValueError) as error:
+            self.logger.info("Connection to {}:{} closed: {}".format(self.host, self.port, error))
+        finally:
+            self._Disconnect(writer, pending)
+
+
+    async def _ReadResponse(self, reader):
+        status_line = (await reader.readuntil(b"\r\n")).decode("latin-1").rstrip("\r\n")
+        _, status, reason = (status_line.split(" ", 2) + [""])[:3]
+        headers = dict()
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode("latin-1").rstrip("\r\n")
+            if line == "":
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        if "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+        return ChatResponse(int(status), reason, headers, body)
+
+
+    def _EncodeRequest(self, method, headers, body):
+        lines = ["{} / HTTP/1.1".format(method), "Host: {}:{}".format(self.host, self.port), "Content-Length: {}".format(len(body))]
+        for name, value in headers.items():
+            line = "{}: {}".format(name, value)
+            if "\r" in line or "\n" in line:
+                raise ValueError("Header {} must not contain line breaks".format(name))
+            try:
+                line.encode("latin-1")
+            except UnicodeEncodeError:
+                raise ValueError("Header {} must be latin-1 text, got {!r}".format(name, value)) from None
+            lines.append(line)
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+# A few pipelined connections to one server, shared by any number of clients.
+# Reads are retried after reconnecting or timing out, writes are not, since the server may already have applied them.
+class ChatTransport:
+    def __init__(self, host="localhost", port=19000, connections=1, max_retries=3, retry_delay=0.5,
+                 timeout=10, poll_interval=0.5, logger=None):
+        self.logger = logger or logging.getLogger("chat_client")
+        self.connections = [PipelinedConnection(host, port, self.logger, timeout) for _ in range(connections)]
+        self.next_connection = itertools.cycle(self.connections)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.feed = ActionFeed(self, poll_interval)
+
+
+    async def Request(self, method, headers, body=b""):
+        attempt = 0
+        while True:
+            try:
+                return await next(self.next_connection).Request(method, headers, body)
+            except (OSError, asyncio.TimeoutError):
+                attempt += 1
+                if method != "GET" or attempt > self.max_retries:
+                    raise
+                self.logger.info("Retrying {} request, attempt {}".format(method, attempt))
+                await asyncio.sleep(self.retry_delay * attempt)
+
+
+    async def Close(self):
+        self.feed.Stop()
+        for connection in self.connections:
+            await connection.Close()
+
+
+# One Get-Chat-Actions poll per transport, whatever the number of subscribers.
+# Every poll's new actions are put into the queue of each subscriber.
+class ActionFeed:
+    def __init__(self, transport, poll_interval):
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self.client = AsyncChatClient(transport)
+        self.queues = set()
+        self.next_action_id = None
+        self.task = None
+
+
+    # Yields the actions starting at from_action_id
+    async def Follow(self, from_action_id):
+        queue = asyncio.Queue()
+        self.queues.add(queue)
+        try:
+            if self.task is None:
+                self.next_action_id = from_action_id
+                self.task = asyncio.get_running_loop().create_task(self._PollForever())
+            next_action_id = from_action_id
+            # Older actions than the feed is at are downloaded once, the queue has everything after them
+            batches = [await self.client.GetChatActions(from_action_id)] if from_action_id < self.next_action_id else []
+            while True:
+                for batch in batches:
+                    for action in batch:
+                        if action["id"] >= next_action_id:
+                            next_action_id = action["id"] + 1
+                            yield action
+                batches = [await queue.get()]
+        finally:
+            self.queues.discard(queue)
+            if len(self.queues) == 0:
+                self.Stop()
+
+
+    def Stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+    async def _PollForever(self):
+        while True:
+            try:
+                actions = await self.client.GetChatActions(self.next_action_id)
+            except (OSError, asyncio.TimeoutError, ChatRequestError) as error:
+                self.transport.logger.info("Polling actions failed: {}".format(error))
+                actions = []
+            if len(actions) > 0:
+                self.next_action_id = actions[-1]["id"] + 1
+                for queue in self.queues:
+                    queue.put_nowait(actions)
+            await asyncio.sleep(self.poll_interval)
+
+
+class AsyncChatClient:
+    def __init__(self, transport):
+        self.transport = transport
+        self.login = None
+        self.session = None
+
+
+    async def SignUp(self, login, password):
+        response = await self._Post({"Sign-Up": "true", "Login": login, "Password": password})
+        self._StartSession(login, response)
+
+
+    async def SignIn(self, login, password):
+        response = await self._Post({"Auth": "true", "Login": login, "Password": password})
+        self._StartSession(login, response)
+
+
+    async def SendMessage(self, message_text):
+        await self._Post({"Send-Message": "true"}, message_text)
+
+
+    async def SendComment(self, message_id, comment_text):
+        await self._Post({"Comment": "true", "Message-ID": str(message_id)}, comment_text)
+
+
+    async def SendReaction(self, message_id, reaction):
+        await self._Post({"Reaction": reaction, "Message-ID": str(message_id)})
+
+
+    async def GetChatState(self):
+        return (await self._Get({"Get-Chat-State": "true"})).Json()
+
+
+    async def GetChatPage(self, first_id, page_size):
+        return (await self._Get({"Get-Chat-Page": "true", "Page-Start": str(first_id), "Page-Size": str(page_size)})).Json()
+
+
+    async def GetChatActions(self, from_action_id=0):
+        return (await self._Get({"Get-Chat-Actions": "true", "From-Action-ID": str(from_action_id)})).Json()
+
+
+    async def GetChatSize(self):
+        return (await self._Get({"Get-Chat-Size": "true"})).Json()
+
+
+    # Read cursor and unread counts: {"cursor", "unread", "mentions", "replies"}
+    async def GetUnread(self):
+        return (await self._Get({"Get-Unread": "true"})).Json()
+
+
+    # Unread counts and every action after the read cursor: {"unread": {...}, "actions": [...]}
+    async def GetUnseenActions(self):
+        return (await self._Get({"Get-Unseen-Actions": "true"})).Json()
+
+
+    async def AckActions(self, action_id):
+        return (await self._Post({"Ack-Actions": "true", "Action-ID": str(action_id)})).Json()
+
+
+    # Yields actions made after the call (or starting at from_action_id), from the transport's shared poll
+    async def Subscribe(self, from_action_id=None):
+        if from_action_id is None:
+            from_action_id = (await self.GetChatSize())["actions"]
+        async for action in self.transport.feed.Follow(from_action_id):
+            yield action
+
+
+    async def Close(self):
+        await self.transport.Close()
+
+
+    def _StartSession(self, login, response):
+        self.login = login
+        self.session = response.headers.get("session")
+
+
+    def _SessionHeaders(self, headers):
+        if self.session is not None:
+            headers["Session"] = self.session
+        return headers
+
+
+    async def _Post(self, headers, body=""):
+        response = await self.transport.Request("POST", self._SessionHeaders(headers), body.encode("utf-8"))
+        return self._Check(response)
+
+
+    async def _Get(self, headers):
+        response = await self.transport.Request("GET", self._SessionHeaders(headers))
+        return self._Check(response)
+
+
+    def _Check(self, response):
+        if response.status != 200:
+            retry_after = response.headers.get("retry-after")
+            raise ChatRequestError(response.status, response.reason, float(retry_after) if retry_after else None)
+        return response
@@ -87,12 +87,23 @@ class ConsoleChatStateManager(ManagerBase):
             print(action.ConsoleString())    
 
 
-    def LoadLast(self, n_last_messages):
-        last_n_actions = [ConsoleChatStateManager.JsonToAction(json_action) for json_action in self.storage.Get()[-n_last_messages:]]
-        for action in last_n_actions: 
+    def ShowActions(self, actions_json):
+        for action in [ConsoleChatStateManager.JsonToAction(json_action) for json_action in actions_json]: 
             print(action.ConsoleString())    
 
 
+    # Prints actions that come after the stored ones and stores them, ids already stored are skipped
+    def AddActions(self, actions_json):
+        self.BasicCheckCorrectness(actions_json)
+        stored_actions = self.storage.Get()
+        last_id = stored_actions[-1]["id"] if len(stored_actions) > 0 else -1
+        new_actions = [action for action in actions_json if action["id"] > last_id]
+        if len(new_actions) == 0:
+            return
+        self.ShowActions(new_actions)
+        self.storage.Update(stored_actions + new_actions)
+
+
     @staticmethod
     def BasicCheckCorrectness(storage):
         assert isinstance(storage, list), "Console State storage must be a list"
@@ -151,13 +162,61 @@ comment = {
 """
 
 
+# Keeps the newest messages_count messages: loaded once from a page of the chat,
+# then kept up to date by applying the actions made after the page.
 class FileChatStateManager(ManagerBase):
 
     default_state = []
 
-    def __init__(self, ui_file_path, storage_path, logger):
+    def __init__(self, ui_file_path, storage_path, logger, messages_count=100):
         super().__init__(storage_path, FileChatStateManager.default_state, logger)
         self.ui_file_path = ui_file_path
+        self.messages_count = messages_count
+        self.next_action_id = None
+
+
+    # page is the json of Get-Chat-Page, next_action_id its Chat-Actions header
+    def LoadPage(self, page, next_action_id):
+        self.next_action_id = next_action_id
+        self.UpdateState(page[-self.messages_count:])
+
+
+    def ApplyActions(self, actions_json):
+        messages = self.storage.Get()
+        changed = False
+        for action in actions_json:
+            if action["id"] < self.next_action_id:
+                continue
+            self.next_action_id = action["id"] + 1
+            changed = FileChatStateManager.ApplyAction(messages, action) or changed
+        if changed:
+            self.UpdateState(messages[-self.messages_count:])
+
+
+    # Returns True if the action changed one of the messages
+    @staticmethod
+    def ApplyAction(messages, action):
+        if action["action_type"] == "add_message":
+            messages.append({
+                "id": action["message_id"],
+                "login": action["login"],
+                "content": action["content"],
+                "comments": [],
+                "reactions": {reaction: 0 for reaction in supported_reactions}
+            })
+            return True
+        if action["action_type"] not in ("add_comment", "add_reaction") or len(messages) == 0:
+            return False
+        position = action["message_id"] - messages[0]["id"]
+        if position < 0 or position >= len(messages):
+            return False
+        if action["action_type"] == "add_comment":
+            messages[position]["comments"].append({"login": action["login"], "content": action["content"]})
+            return True
+        if action["content"] in supported_reactions:
+            messages[position]["reactions"][action["content"]] += 1
+            return True
+        return False
 
 
     def UpdateUI(self, storage):
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The client is run from its own directory, so its modules are imported as "lib.*"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
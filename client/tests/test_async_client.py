@@ -0,0 +1,145 @@
+import json
+import time
+import asyncio
+import pytest
+from lib.async_client import ChatTransport, AsyncChatClient
+
+
+# A keep-alive HTTP server that answers with handle(connection_number, method, headers),
+# which returns (status, body) or None to drop the connection without an answer
+class FakeServer:
+    def __init__(self, handle):
+        self.handle = handle
+        self.requests = []
+        self.connections = 0
+
+
+    async def Start(self):
+        self.server = await asyncio.start_server(self._Serve, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+    async def _Serve(self, reader, writer):
+        self.connections += 1
+        connection_number = self.connections
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+                method = head[0].split(" ")[0]
+                headers = dict(line.split(": ", 1) for line in head[1:] if line)
+                await reader.readexactly(int(headers["Content-Length"]))
+                self.requests.append((method, headers))
+                answer = await self.handle(connection_number, method, headers)
+                if answer is None:
+                    break
+                status, body = answer
+                writer.write("HTTP/1.1 {} OK\r\nContent-Length: {}\r\n\r\n{}".format(status, len(body), body).encode("latin-1"))
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+
+async def with_server(handle, test, **transport_options):
+    server = FakeServer(handle)
+    port = await server.Start()
+    transport = ChatTransport("127.0.0.1", port, retry_delay=0.01, **transport_options)
+    try:
+        await test(server, transport)
+    finally:
+        await transport.Close()
+        server.server.close()
+
+
+def test_pipelined_responses_are_matched_in_order():
+    async def handle(connection_number, method, headers):
+        # The first answer is the slowest, the others wait behind it
+        await asyncio.sleep(0.1 if headers["Page-Start"] == "0" else 0)
+        return 200, json.dumps([int(headers["Page-Start"])])
+
+    async def test(server, transport):
+        client = AsyncChatClient(transport)
+        pages = await asyncio.gather(*(client.GetChatPage(first_id, 1) for first_id in range(5)))
+        assert pages == [[first_id] for first_id in range(5)]
+        assert server.connections == 1
+
+    asyncio.run(with_server(handle, test))
+
+
+def test_reads_are_retried_after_reconnecting_and_writes_are_not():
+    dropped = set()
+
+    async def handle(connection_number, method, headers):
+        # The first request of each method loses its connection
+        if method not in dropped:
+            dropped.add(method)
+            return None
+        return 200, json.dumps({"messages": 1, "actions": 2})
+
+    async def test(server, transport):
+        client = AsyncChatClient(transport)
+        assert await client.GetChatSize() == {"messages": 1, "actions": 2}
+        with pytest.raises(ConnectionResetError):
+            await client.SendMessage("hi")
+        assert [method for method, _ in server.requests].count("POST") == 1
+
+    asyncio.run(with_server(handle, test))
+
+
+def test_unanswered_request_times_out():
+    async def handle(connection_number, method, headers):
+        if connection_number == 1:
+            await asyncio.sleep(10)
+        return 200, "[]"
+
+    async def test(server, transport):
+        client = AsyncChatClient(transport)
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await client.SendMessage("hi")
+        assert time.monotonic() - start < 1
+        # Reads are retried on a new connection
+        assert await client.GetChatActions(0) == []
+
+    asyncio.run(with_server(handle, test, timeout=0.2))
+
+
+def test_header_values_are_checked():
+    async def handle(connection_number, method, headers):
+        return 200, ""
+
+    async def test(server, transport):
+        client = AsyncChatClient(transport)
+        with pytest.raises(ValueError, match="line breaks"):
+            await client.SignIn("login\r\nAuth: true", "password")
+        with pytest.raises(ValueError, match="latin-1"):
+            await client.SignIn("логин", "password")
+        assert server.requests == []
+
+    asyncio.run(with_server(handle, test))
+
+
+def test_subscribers_share_one_poll():
+    actions = [{"id": action_id, "action_type": "add_message", "login": "login", "message_id": action_id, "content": "text"}
+               for action_id in range(4)]
+
+    async def handle(connection_number, method, headers):
+        if "Get-Chat-Size" in headers:
+            return 200, json.dumps({"messages": 1, "actions": 1})
+        return 200, json.dumps(actions[int(headers["From-Action-ID"]):])
+
+    async def receive(subscription, count):
+        return [(await subscription.__anext__())["id"] for _ in range(count)]
+
+    async def test(server, transport):
+        clients = [AsyncChatClient(transport) for _ in range(10)]
+        first = clients[0].Subscribe(from_action_id=0)
+        received = [await receive(first, 4)]
+        received.extend(await asyncio.gather(*(receive(client.Subscribe(), 3) for client in clients[1:])))
+        assert received == [[0, 1, 2, 3]] + [[1, 2, 3]] * 9
+
+        polls = sum("From-Action-ID" in headers for _, headers in server.requests)
+        await asyncio.sleep(0.3)
+        # One poll every 0.05 s for all of them, not one per client
+        assert sum("From-Action-ID" in headers for _, headers in server.requests) - polls <= 8
+
+    asyncio.run(with_server(handle, test, poll_interval=0.05))
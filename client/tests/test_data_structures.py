@@ -0,0 +1,24 @@
+import logging
+from lib.data_structures import ConsoleChatStateManager
+
+logger = logging.getLogger("test_data_structures")
+
+
+def action(action_id, content):
+    return {"id": action_id, "action_type": "add_message", "login": "a", "message_id": action_id, "content": content}
+
+
+def test_add_actions_skips_stored_ids(tmp_path, capsys):
+    manager = ConsoleChatStateManager(str(tmp_path / "console.json"), logger)
+    manager.AddActions([action(0, "first"), action(1, "second")])
+    capsys.readouterr()
+
+    # A poll that overlaps what is already shown
+    manager.AddActions([action(1, "second"), action(2, "third")])
+    assert [stored["id"] for stored in manager.storage.Get()] == [0, 1, 2]
+    printed = capsys.readouterr().out
+    assert "third" in printed and "second" not in printed
+
+    manager.AddActions([action(0, "first")])
+    assert len(manager.storage.Get()) == 3
+    assert capsys.readouterr().out == ""
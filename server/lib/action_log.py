@@ -0,0 +1,129 @@
+import os
+import json
+import time
+
+# Append-only stream of actions, one json object per line, and the primary's record of all actions.
+# The primary appends to it, read replicas tail it.
+# Every line also carries "ts", the time it was written, so replicas can tell how old their lag is.
+class ActionLog:
+    def __init__(self, log_path, logger):
+        self.log_path = log_path
+        self.logger = logger
+        self.size = 0
+
+        if os.path.isfile(self.log_path):
+            with open(self.log_path, "rb+") as file:
+                complete_size = 0
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    complete_size += len(line)
+                    self.size += 1
+                # A line cut short by a crash would be glued to the next action
+                if file.tell() > complete_size:
+                    self.logger.warning("Dropping a partially written line at the end of {}".format(self.log_path))
+                    file.truncate(complete_size)
+        else:
+            self.logger.info("Action log {} does not exist, creating it".format(self.log_path))
+            open(self.log_path, "w").close()
+
+
+    def ReadAll(self):
+        with open(self.log_path, "r") as file:
+            return [json.loads(line) for line in file]
+
+
+    # Appends the actions the log is missing, e.g. history written before the log existed
+    def Backfill(self, actions):
+        if self.size < len(actions):
+            self.logger.info("Backfilling action log {} with {} actions".format(self.log_path, len(actions) - self.size))
+            self._Write(actions[self.size:])
+
+
+    def Append(self, action):
+        self._Write([action])
+
+
+    def _Write(self, actions):
+        ts = round(time.time(), 3)
+        with open(self.log_path, "a") as file:
+            file.write("".join(json.dumps(dict(action, ts=ts)) + "\n" for action in actions))
+        self.size += len(actions)
+
+
+# Reads the log from a byte offset, at most max_read_bytes at a time.
+# A partially written last line is picked up on a later read.
+class ActionLogTailer:
+    def __init__(self, log_path, logger, max_read_bytes=4 * 1024 * 1024):
+        self.log_path = log_path
+        self.logger = logger
+        self.max_read_bytes = max_read_bytes
+        self.offset = 0
+
+
+    # Modification time and size of the log, the current time and 0 if there is no log yet
+    def Stat(self):
+        if not os.path.isfile(self.log_path):
+            return time.time(), 0
+        stat = os.stat(self.log_path)
+        return stat.st_mtime, stat.st_size
+
+
+    def ReadNew(self):
+        actions = []
+        if not os.path.isfile(self.log_path):
+            return actions
+        with open(self.log_path, "rb") as file:
+            file.seek(self.offset)
+            read_bytes = 0
+            for line in file:
+                if not line.endswith(b"\n") or read_bytes >= self.max_read_bytes:
+                    break
+                actions.append(json.loads(line))
+                read_bytes += len(line)
+        self.offset += read_bytes
+        return actions
+
+
+    # Moves past lines without parsing them, e.g. the actions a snapshot already has
+    def SkipLines(self, count):
+        if not os.path.isfile(self.log_path):
+            return
+        with open(self.log_path, "rb") as file:
+            file.seek(self.offset)
+            chunk_offset = self.offset
+            while count > 0:
+                chunk = file.read(self.max_read_bytes)
+                if len(chunk) == 0:
+                    break
+                newlines = chunk.count(b"\n")
+                if newlines < count:
+                    if newlines > 0:
+                        self.offset = chunk_offset + chunk.rfind(b"\n") + 1
+                    count -= newlines
+                    chunk_offset += len(chunk)
+                    continue
+                end = 0
+                for _ in range(count):
+                    end = chunk.index(b"\n", end) + 1
+                self.offset = chunk_offset + end
+                count = 0
+
+
+    # Write time of the first line that has not been read yet, None if there is no complete line
+    # or the line was written before the log had timestamps
+    def FirstUnreadTimestamp(self):
+        if not os.path.isfile(self.log_path):
+            return None
+        with open(self.log_path, "rb") as file:
+            file.seek(self.offset)
+            line = file.readline()
+        if not line.endswith(b"\n"):
+            return None
+        return json.loads(line).get("ts")
+
+
+    def BytesBehind(self):
+        if not os.path.isfile(self.log_path):
+            return 0
+        return os.path.getsize(self.log_path) - self.offset
@@ -1,8 +1,31 @@
+import re
+import sys
 import json
 from abc import ABC, abstractmethod
+from array import array
+from collections import deque
 from .json_storage import JsonStorage
+from .segment_storage import SegmentStorage
+from .action_log import ActionLog
 
-supported_reactions = set(("Thumbs Up", "Thumbs Down", "Love", "Fire", "Pile of Poo"))
+reaction_names = ("Thumbs Up", "Thumbs Down", "Love", "Fire", "Pile of Poo")
+supported_reactions = set(reaction_names)
+reaction_index = {reaction: index for index, reaction in enumerate(reaction_names)}
+
+action_types = ("sign_up", "add_message", "add_comment", "add_reaction")
+action_type_code = {action_type: code for code, action_type in enumerate(action_types)}
+no_message_id = -(2 ** 63) # stands for a null message_id in the int64 column
+
+
+# Returns the message id as an int, or None if it is not an int that fits the message_id column
+def ParseMessageId(value):
+    try:
+        message_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    if no_message_id < message_id < 2 ** 63:
+        return message_id
+    return None
 
 class DataItem:
     def __init__(self, action_type, login, message_id, content):
@@ -12,6 +35,111 @@ class DataItem:
         self.content = content
 
 
+# Compact in-memory message: interned logins, comments as (login, content) tuples
+# (None until the first one) and an array of reaction counters in reaction_names order.
+# The json dict is built only when the message is serialized.
+class MessageRecord:
+    __slots__ = ("id", "login", "content", "comments", "reactions")
+
+    def __init__(self, message_id, login, content, comments=None, reactions=None):
+        self.id = message_id
+        self.login = sys.intern(login)
+        self.content = content
+        self.comments = comments
+        self.reactions = reactions if reactions is not None else array("I", [0] * len(reaction_names))
+
+
+    def AddComment(self, login, content):
+        if self.comments is None:
+            self.comments = []
+        self.comments.append((sys.intern(login), content))
+
+
+    def AddReaction(self, reaction):
+        self.reactions[reaction_index[reaction]] += 1
+
+
+    def ToJson(self):
+        return {
+            "id": self.id,
+            "login": self.login,
+            "content": self.content,
+            "comments": [{"login": login, "content": content} for login, content in self.comments or ()],
+            "reactions": dict(zip(reaction_names, self.reactions))
+        }
+
+
+    @staticmethod
+    def FromJson(message):
+        comments = [(sys.intern(comment["login"]), comment["content"]) for comment in message["comments"]]
+        reactions = array("I", (message["reactions"][reaction] for reaction in reaction_names))
+        return MessageRecord(message["id"], message["login"], message["content"], comments or None, reactions)
+
+
+# Actions stored column by column: type codes and message ids in typed arrays,
+# interned logins and contents in lists. An action id is its index.
+class ActionColumns:
+    def __init__(self):
+        self.action_types = array("B")
+        self.logins = []
+        self.message_ids = array("q")
+        self.contents = []
+
+
+    def __len__(self):
+        return len(self.action_types)
+
+
+    def Append(self, action_type, login, message_id, content):
+        # Everything is checked before the first column grows, so the columns never get different lengths
+        type_code = action_type_code[action_type]
+        message_id_value = no_message_id if message_id is None else ParseMessageId(message_id)
+        if message_id_value is None:
+            raise ValueError("Message ID {} does not fit the message_id column".format(message_id))
+        self.action_types.append(type_code)
+        self.logins.append(sys.intern(login))
+        self.message_ids.append(message_id_value)
+        self.contents.append(content)
+        return len(self) - 1
+
+
+    def AppendJson(self, action):
+        assert action["id"] == len(self), "Check correct id-ing"
+        return self.Append(action["action_type"], action["login"], action["message_id"], action["content"])
+
+
+    def ToJson(self, action_id):
+        message_id = self.message_ids[action_id]
+        return {
+            "id": action_id,
+            "action_type": action_types[self.action_types[action_id]],
+            "login": self.logins[action_id],
+            "message_id": None if message_id == no_message_id else message_id,
+            "content": self.contents[action_id]
+        }
+
+
+    # One json.dumps over the whole list, the columns are zipped instead of indexed per action
+    def GetString(self, first_id=0):
+        first_id = max(first_id, 0)
+        return json.dumps([
+            {
+                "id": action_id,
+                "action_type": action_types[type_code],
+                "login": login,
+                "message_id": None if message_id == no_message_id else message_id,
+                "content": content
+            }
+            for action_id, type_code, login, message_id, content in zip(
+                range(first_id, len(self)),
+                self.action_types[first_id:],
+                self.logins[first_id:],
+                self.message_ids[first_id:],
+                self.contents[first_id:]
+            )
+        ])
+
+
 class DataBase(ABC):
     def __init__(self, storage_path, default_state, logger):
         self.logger = logger
@@ -80,29 +208,112 @@ class Actions(DataBase):
 
     default_state = list()
 
-    def __init__(self, logger, path):
+    # The action log is the record of all actions. It is written first, so it may be ahead of
+    # the json file, which is only rewritten from the log on start and serves as a snapshot for replicas.
+    def __init__(self, logger, path, log_path):
         super().__init__(path, Actions.default_state, logger)
+        self.log = ActionLog(log_path, logger)
+        self.columns = ActionColumns()
+        self.listeners = []
+        stored_actions = self.storage.Get()
+        self.log.Backfill(stored_actions)
+        for action in self.log.ReadAll():
+            self.columns.AppendJson(action)
+        if len(self.columns) != len(stored_actions):
+            self.storage.UpdateString(self.columns.GetString())
 
 
-    def CreateItem(self, storage, item):
-        next_id = len(storage)
-        action = {
-            "id" : next_id, 
-            "action_type": item.action_type, 
-            "login": item.login, 
-            "message_id" : item.message_id,
-            "content": item.content
-        }
-        storage.append(action)
+    # A listener's ActionAdded(columns, action_id) is called after every new action
+    def AddListener(self, listener):
+        self.listeners.append(listener)
+
+
+    def Add(self, item):
+        self.CreateItem(self.columns, item)
+        for listener in self.listeners:
+            listener.ActionAdded(self.columns, len(self.columns) - 1)
+
+
+    def CreateItem(self, columns, item):
+        action_id = columns.Append(item.action_type, item.login, item.message_id, item.content)
+        self.log.Append(columns.ToJson(action_id))
+
+
+    def GetString(self):
+        return self.columns.GetString()
+
 
+    def GetStringFrom(self, first_id):
+        return self.columns.GetString(first_id)
 
+
+    def Size(self):
+        return len(self.columns)
+
+
+# Tiered storage: the newest messages live in memory (and in the hot json file),
+# older ones are sealed into compressed segments and loaded only when touched
 class Messages(DataBase):
 
     default_state = list()
 
-    def __init__(self, logger, path):
+    def __init__(self, logger, path, segments_dir, hot_window_size=500, segment_size=500, segment_cache_size=8):
         super().__init__(path, Messages.default_state, logger)
- 
+        self.hot_window_size = hot_window_size
+        self.segment_size = segment_size
+        self.cold = SegmentStorage(segments_dir, segment_cache_size, MessageRecord.FromJson, logger)
+        # Messages that were already sealed are dropped in case we stopped between sealing and rewriting the hot file
+        self.hot_first_id = self.cold.Size()
+        self.hot = [MessageRecord.FromJson(message) for message in self.storage.Get() if message["id"] >= self.hot_first_id]
+        self.CheckStorageCorrect(self.hot)
+        self.SealOverflow()
+
+
+    def Add(self, item):
+        self.CheckStorageCorrect(self.hot)
+        self.CreateItem(self.hot, item)
+        self.SealOverflow()
+        self.storage.Update(self.HotJson())
+
+
+    def HotJson(self):
+        return [message.ToJson() for message in self.hot]
+
+
+    def GetString(self):
+        return json.dumps(self.cold.GetAllJson() + self.HotJson())
+
+
+    def GetPageString(self, first_id, page_size):
+        first_id = max(first_id, 0)
+        last_id = min(first_id + max(page_size, 0), self.Size()) - 1
+        page = self.cold.GetRange(first_id, min(last_id, self.hot_first_id - 1))
+        if last_id >= self.hot_first_id:
+            page.extend(self.hot[max(first_id - self.hot_first_id, 0):last_id - self.hot_first_id + 1])
+        return json.dumps([message.ToJson() for message in page])
+
+
+    def Size(self):
+        return self.hot_first_id + len(self.hot)
+
+
+    def CheckStorageCorrect(self, storage):
+        if len(storage) > 0:
+            assert isinstance(storage[-1], MessageRecord), "Array must consist of message records!"
+            assert self.hot_first_id + len(storage) == storage[-1].id + 1, "Check correct id-ing"
+
+
+    # Moves the oldest hot messages into a new segment once the hot window overflows by a whole segment
+    def SealOverflow(self):
+        n_segments = max(len(self.hot) - self.hot_window_size, 0) // self.segment_size
+        if n_segments == 0:
+            return
+        n_sealed = n_segments * self.segment_size
+        self.cold.Seal([self.hot[begin:begin + self.segment_size] for begin in range(0, n_sealed, self.segment_size)])
+        self.hot = self.hot[n_sealed:]
+        self.hot_first_id += n_sealed
+        self.storage.Update(self.HotJson())
+
 
     def CreateItem(self, storage, item):
         if item.action_type == "add_message":         
@@ -114,21 +325,8 @@ class Messages(DataBase):
 
 
     def AddMessage(self, storage, item):
-        next_id = len(storage)
-        message = {
-            "id": next_id,
-            "login": item.login,
-            "content": item.content,
-            "comments": [],
-            "reactions": {
-                "Thumbs Up": 0,
-                "Thumbs Down": 0,
-                "Love": 0,
-                "Fire": 0,
-                "Pile of Poo": 0
-            }
-        }
-        storage.append(message)
+        next_id = self.Size()
+        storage.append(MessageRecord(next_id, item.login, item.content))
         self.logger.info("New message \"{}\" with message_id {} by (login) {}!".format(item.content, item.message_id, item.login))
 
 
@@ -136,11 +334,8 @@ class Messages(DataBase):
         if self.MessageIdIsIncorrect(item.message_id):
             return
 
-        comment = {
-            "login" : item.login,
-            "content": item.content
-        }
-        storage[int(item.message_id)]["comments"].append(comment)
+        self.GetMessage(int(item.message_id)).AddComment(item.login, item.content)
+        self.MessageUpdated(int(item.message_id))
         self.logger.info("Comment \"{}\" for message_id {} by (login) {}!".format(item.content, item.message_id, item.login))
 
 
@@ -149,14 +344,136 @@ class Messages(DataBase):
             return
 
         if item.content in supported_reactions:
-            storage[int(item.message_id)]["reactions"][item.content] += 1
+            self.GetMessage(int(item.message_id)).AddReaction(item.content)
+            self.MessageUpdated(int(item.message_id))
             self.logger.info("Reaction \"{}\" for message_id {} by (login) {}!".format(item.content, item.message_id, item.login))
 
 
+    def GetMessage(self, message_id):
+        if message_id >= self.hot_first_id:
+            return self.hot[message_id - self.hot_first_id]
+        return self.cold.Get(message_id)
+
+
+    # Hot messages are persisted by Add, cold ones need their segment rewritten
+    def MessageUpdated(self, message_id):
+        if message_id < self.hot_first_id:
+            self.cold.Update(message_id)
+
+
     def MessageIdIsIncorrect(self, message_id):
-        storage_size = len(self.storage.Get())
+        storage_size = self.Size()
         is_incorrect = int(message_id) < 0 or int(message_id) >= storage_size 
         if is_incorrect:
             self.logger.info("Message ID {} is incorrect: storage's size is {}".format(message_id, storage_size))
         return is_incorrect 
 
+
+# The last action each login has acknowledged, persisted as login -> action id.
+# For every tracked login the ids of unread mentions ("@login" in a message or comment)
+# and replies (comments on the login's messages) are kept, so the unread counts
+# are updated as actions are added instead of being recomputed from the history.
+class ReadCursors(DataBase):
+
+    default_state = dict()
+    mention_pattern = re.compile(r"@(\w+)")
+
+    # Every member has a cursor from its sign up on, so counts are only updated as actions
+    # arrive; history is scanned once on start, from the oldest stored cursor.
+    def __init__(self, logger, path, actions, messages):
+        super().__init__(path, ReadCursors.default_state, logger)
+        self.actions = actions
+        self.messages = messages
+        self.cursors = self.storage.Get()
+        # Unread action ids per login: mentions of the login and comments on its messages
+        self.mentions = {login: deque() for login in self.cursors}
+        self.replies = {login: deque() for login in self.cursors}
+        # Number of the login's own actions after its cursor
+        self.own = {login: 0 for login in self.cursors}
+        self.Scan(min(self.cursors.values(), default=self.actions.Size() - 1) + 1, self.cursors)
+        # Members that signed up before cursors were kept have seen everything up to now
+        sign_up_code = action_type_code["sign_up"]
+        for type_code, login in zip(self.actions.columns.action_types, self.actions.columns.logins):
+            if type_code == sign_up_code:
+                self.Track(login)
+        self.storage.Update(self.cursors)
+        self.actions.AddListener(self)
+
+
+    # Acknowledge
+    def CreateItem(self, storage, item):
+        previous_cursor = storage[item.login]
+        storage[item.login] = item.content # content is the last acknowledged action id
+        self.own[item.login] -= self.actions.columns.logins[previous_cursor + 1:item.content + 1].count(item.login)
+        for unread_ids in (self.mentions[item.login], self.replies[item.login]):
+            while len(unread_ids) > 0 and unread_ids[0] <= item.content:
+                unread_ids.popleft()
+
+
+    def Acknowledge(self, login, action_id):
+        self.Track(login)
+        action_id = min(max(self.cursors[login], action_id), self.actions.Size() - 1)
+        if action_id != self.cursors[login]:
+            self.CreateItem(self.cursors, DataItem("acknowledge", login, None, action_id))
+            self.storage.Update(self.cursors)
+            self.logger.info("Login {} acknowledged actions up to {}".format(login, action_id))
+        return self.Unread(login)
+
+
+    def Unread(self, login):
+        self.Track(login)
+        cursor = self.cursors[login]
+        return {
+            "cursor": cursor,
+            "unread": self.actions.Size() - 1 - cursor - self.own[login],
+            "mentions": len(self.mentions[login]),
+            "replies": len(self.replies[login])
+        }
+
+
+    def GetUnseenString(self, login):
+        unread = self.Unread(login)
+        return '{{"unread": {}, "actions": {}}}'.format(json.dumps(unread), self.actions.GetStringFrom(unread["cursor"] + 1))
+
+
+    # A login without a cursor starts with everything up to now seen
+    def Track(self, login, cursor=None):
+        if login in self.cursors:
+            return
+        self.cursors[login] = self.actions.Size() - 1 if cursor is None else cursor
+        self.mentions[login] = deque()
+        self.replies[login] = deque()
+        self.own[login] = 0
+
+
+    def Scan(self, first_id, logins):
+        for action_id in range(max(first_id, 0), self.actions.Size()):
+            self.Count(self.actions.columns, action_id, logins)
+
+
+    def ActionAdded(self, columns, action_id):
+        if action_types[columns.action_types[action_id]] == "sign_up":
+            self.Track(columns.logins[action_id], cursor=action_id)
+            self.storage.Update(self.cursors)
+        self.Count(columns, action_id, self.cursors)
+
+
+    def Count(self, columns, action_id, logins):
+        action_type = action_types[columns.action_types[action_id]]
+        author = columns.logins[action_id]
+        if self.IsUnread(author, action_id, logins):
+            self.own[author] += 1
+        if action_type in ("add_message", "add_comment"):
+            for mentioned in set(ReadCursors.mention_pattern.findall(columns.contents[action_id])):
+                if mentioned != author and self.IsUnread(mentioned, action_id, logins):
+                    self.mentions[mentioned].append(action_id)
+        if action_type == "add_comment":
+            message_id = columns.message_ids[action_id]
+            if 0 <= message_id < self.messages.Size():
+                message_author = self.messages.GetMessage(message_id).login
+                if message_author != author and self.IsUnread(message_author, action_id, logins):
+                    self.replies[message_author].append(action_id)
+
+
+    def IsUnread(self, login, action_id, logins):
+        return login in logins and self.cursors[login] < action_id
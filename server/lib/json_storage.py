@@ -29,7 +29,11 @@ class JsonStorage:
 
 
     def Update(self, new_state):
+        self.UpdateString(json.dumps(new_state))
+
+
+    def UpdateString(self, new_state_string):
         self.logger.info("Updating state of {}".format(self.data_path))
         with open(self.data_path, "w") as file:
-            file.write(json.dumps(new_state))
+            file.write(new_state_string)
 
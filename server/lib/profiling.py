@@ -0,0 +1,117 @@
+import io
+import os
+import re
+import sys
+import time
+import random
+import pstats
+import cProfile
+import threading
+import traceback
+import tracemalloc
+
+# A request in flight, stack is filled in by the watchdog once the request passes its deadline
+class WatchedRequest:
+    __slots__ = ("thread_id", "deadline", "stack")
+
+    def __init__(self, thread_id, deadline):
+        self.thread_id = thread_id
+        self.deadline = deadline
+        self.stack = None
+
+
+# Profiles sampled requests with cProfile and tracemalloc and warns about slow ones.
+# With a sample rate of 0 and no slow_request_ms only requests run with force_profile are profiled.
+class RequestProfiler:
+    def __init__(self, logger, profiles_dir, sample_rate, slow_request_ms=None):
+        self.logger = logger
+        self.profiles_dir = profiles_dir
+        self.sample_rate = sample_rate
+        self.slow_request_ms = slow_request_ms
+        # Whether every request should go through Run, not only the forced ones
+        self.watches_all = sample_rate > 0 or slow_request_ms is not None
+        # tracemalloc is process wide, so one request is profiled at a time
+        self.profile_lock = threading.Lock()
+        # One watchdog thread captures the stacks of all requests that pass slow_request_ms
+        self.watched = set()
+        self.watch_condition = threading.Condition()
+        self.watchdog = None
+
+
+    def Run(self, route, handle, force_profile=False):
+        profiled = (force_profile or random.random() < self.sample_rate) and self.profile_lock.acquire(blocking=False)
+        watched = self._Watch() if self.slow_request_ms is not None else None
+        profile = None
+        start = time.perf_counter()
+        try:
+            if profiled:
+                tracemalloc.start()
+                profile = cProfile.Profile()
+                profile.enable()
+            handle()
+        finally:
+            if profiled:
+                profile.disable()
+            latency_ms = (time.perf_counter() - start) * 1000
+            if watched is not None:
+                self._Unwatch(watched)
+            if profiled:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                self.profile_lock.release()
+                self._Save(route, latency_ms, profile, snapshot)
+            if watched is not None and latency_ms > self.slow_request_ms:
+                self._WarnSlow(route, latency_ms, watched.stack, profile)
+
+
+    def _Watch(self):
+        watched = WatchedRequest(threading.get_ident(), time.perf_counter() + self.slow_request_ms / 1000)
+        with self.watch_condition:
+            if self.watchdog is None:
+                self.watchdog = threading.Thread(target=self._WatchForever, daemon=True)
+                self.watchdog.start()
+            self.watched.add(watched)
+            self.watch_condition.notify()
+        return watched
+
+
+    def _Unwatch(self, watched):
+        with self.watch_condition:
+            self.watched.discard(watched)
+
+
+    # Sleeps until the nearest deadline, or until a request with a nearer one comes in
+    def _WatchForever(self):
+        with self.watch_condition:
+            while True:
+                now = time.perf_counter()
+                waiting = [watched for watched in self.watched if watched.stack is None]
+                for watched in waiting:
+                    if watched.deadline <= now:
+                        watched.stack = self._CaptureStack(watched.thread_id)
+                deadlines = [watched.deadline for watched in waiting if watched.stack is None]
+                self.watch_condition.wait(min(deadlines) - now if len(deadlines) > 0 else None)
+
+
+    def _CaptureStack(self, thread_id):
+        frame = sys._current_frames().get(thread_id)
+        return traceback.format_stack(frame) if frame is not None else []
+
+
+    def _Save(self, route, latency_ms, profile, snapshot):
+        if not os.path.isdir(self.profiles_dir):
+            os.makedirs(self.profiles_dir)
+        name = "{}_{}_{:.1f}ms".format(int(time.time() * 1000), re.sub(r"[^\w-]", "_", route), latency_ms)
+        path = os.path.join(self.profiles_dir, name)
+        profile.dump_stats(path + ".prof")
+        snapshot.dump(path + ".tracemalloc")
+        self.logger.info("Saved profile of {} ({:.1f} ms) to {}".format(route, latency_ms, path))
+
+
+    def _WarnSlow(self, route, latency_ms, slow_stack, profile):
+        breakdown = "Stack after {} ms:\n{}".format(self.slow_request_ms, "".join(slow_stack or []) or "not captured\n")
+        if profile is not None:
+            stats_text = io.StringIO()
+            pstats.Stats(profile, stream=stats_text).sort_stats("cumulative").print_stats(15)
+            breakdown += stats_text.getvalue()
+        self.logger.warning("Slow request {}: {:.1f} ms\n{}".format(route, latency_ms, breakdown))
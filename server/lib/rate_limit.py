@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import OrderedDict
+
+# A rate of 0 freezes a kind of request, clients are then told to come back after this many seconds
+max_wait_time = 3600.0
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+
+    def Refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    # Seconds to wait until a token is available, 0 if one is available right now
+    def WaitTime(self):
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return max_wait_time
+        return min((1 - self.tokens) / self.rate, max_wait_time)
+
+
+    def Take(self):
+        self.tokens -= 1
+
+
+# Token buckets per (request kind, key), keys are ("login", login) and ("ip", client ip).
+# Least recently used buckets are forgotten once there are more than max_buckets of them.
+class RateLimiter:
+    def __init__(self, limits, logger, max_buckets=100000):
+        self.limits = limits # (kind, "login" or "ip") -> (tokens per second, burst)
+        self.logger = logger
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    # Takes a token from the bucket of every limited key, or from none of them.
+    # Returns 0 if the request is allowed and the seconds to wait otherwise.
+    def Check(self, kind, keys):
+        keys = [key for key in keys if (kind, key[0]) in self.limits]
+        now = time.monotonic()
+        with self.lock:
+            buckets = [self._GetBucket((kind, key), *self.limits[(kind, key[0])], now) for key in keys]
+            wait_time = max([bucket.WaitTime() for bucket in buckets], default=0.0)
+            if wait_time > 0:
+                self.logger.info("Rate limit for {} hit by {}, retry in {:.2f} s".format(kind, keys, wait_time))
+                return wait_time
+            for bucket in buckets:
+                bucket.Take()
+            return 0.0
+
+
+    def _GetBucket(self, bucket_key, rate, burst, now):
+        if bucket_key in self.buckets:
+            self.buckets.move_to_end(bucket_key)
+            bucket = self.buckets[bucket_key]
+        else:
+            bucket = TokenBucket(rate, burst, now)
+            self.buckets[bucket_key] = bucket
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        bucket.Refill(now)
+        return bucket
+
+
+# Caps the number of writes that are being processed or waiting for storage at the same time
+class AdmissionControl:
+    def __init__(self, max_in_flight, logger):
+        self.max_in_flight = max_in_flight
+        self.logger = logger
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+
+    def TryEnter(self):
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                self.logger.info("Shedding write: {} writes in flight".format(self.in_flight))
+                return False
+            self.in_flight += 1
+            return True
+
+
+    def Leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def ParseRateLimit(value):
+    rate, burst = value.split(":")
+    rate, burst = float(rate), float(burst)
+    if rate < 0 or burst < 0:
+        raise ValueError("Rate limit {} must not be negative".format(value))
+    return rate, burst
@@ -0,0 +1,134 @@
+import json
+import time
+import threading
+from .action_log import ActionLogTailer
+from .data_structures import ActionColumns, MessageRecord, supported_reactions
+
+# Read-only copies of Actions and Messages, rebuilt from the primary's action log.
+# Both views expose the read methods the request handler uses on the primary's storage.
+class ReplicaActions:
+    def __init__(self, lock):
+        self.lock = lock
+        self.columns = ActionColumns()
+
+
+    def GetString(self):
+        with self.lock:
+            return self.columns.GetString()
+
+
+    def GetStringFrom(self, first_id):
+        with self.lock:
+            return self.columns.GetString(first_id)
+
+
+    def Size(self):
+        return len(self.columns)
+
+
+class ReplicaMessages:
+    def __init__(self, lock):
+        self.lock = lock
+        self.messages = []
+
+
+    def GetString(self):
+        with self.lock:
+            return json.dumps([message.ToJson() for message in self.messages])
+
+
+    def GetPageString(self, first_id, page_size):
+        first_id = max(first_id, 0)
+        with self.lock:
+            return json.dumps([message.ToJson() for message in self.messages[first_id:first_id + page_size]])
+
+
+    def Size(self):
+        return len(self.messages)
+
+
+    # Same rules as Messages.CreateItem, applied to an action json
+    def Apply(self, action):
+        if action["action_type"] == "add_message":
+            self.messages.append(MessageRecord(len(self.messages), action["login"], action["content"]))
+            return
+        if action["action_type"] not in ("add_comment", "add_reaction"):
+            return
+        message_id = int(action["message_id"])
+        if message_id < 0 or message_id >= len(self.messages):
+            return
+        if action["action_type"] == "add_comment":
+            self.messages[message_id].AddComment(action["login"], action["content"])
+        elif action["content"] in supported_reactions:
+            self.messages[message_id].AddReaction(action["content"])
+
+
+class Replica:
+    def __init__(self, logger, log_path, snapshot_path=None, poll_interval=0.1):
+        self.logger = logger
+        self.poll_interval = poll_interval
+        # Reentrant, so that request handlers can read the actions and messages together
+        self.lock = threading.RLock()
+        self.actions = ReplicaActions(self.lock)
+        self.messages = ReplicaMessages(self.lock)
+        self.tailer = ActionLogTailer(log_path, logger)
+
+        if snapshot_path is not None:
+            self.logger.info("Starting replica from snapshot {}".format(snapshot_path))
+            with open(snapshot_path, "r") as file:
+                self.ApplyActions(json.load(file))
+            # The log starts with the same actions, one per line
+            self.tailer.SkipLines(self.actions.Size())
+        self.CatchUp()
+
+
+    def ApplyActions(self, actions):
+        with self.lock:
+            for action in actions:
+                assert action["id"] == self.actions.Size(), "Action log is out of order at id {}".format(action["id"])
+                self.actions.columns.AppendJson(action)
+                self.messages.Apply(action)
+
+
+    # Applies what was in the log when the call started
+    def CatchUp(self):
+        _, log_size = self.tailer.Stat()
+        while self.tailer.offset < log_size:
+            new_actions = self.tailer.ReadNew()
+            if len(new_actions) == 0:
+                break
+            self.ApplyActions(new_actions)
+            self.logger.info("Replica applied {} actions, now at {}".format(len(new_actions), self.actions.Size()))
+
+
+    # Age of the oldest action the replica has not applied yet
+    def LagSeconds(self):
+        if self.tailer.BytesBehind() == 0:
+            return 0.0
+        written = self.tailer.FirstUnreadTimestamp()
+        if written is None:
+            # Lines from before the log had timestamps are at least as old as the last write
+            written, _ = self.tailer.Stat()
+        return max(time.time() - written, 0.0)
+
+
+    def Status(self):
+        return {
+            "applied_actions": self.actions.Size(),
+            "lag_bytes": self.tailer.BytesBehind(),
+            "lag_seconds": round(self.LagSeconds(), 3)
+        }
+
+
+    def Start(self):
+        thread = threading.Thread(target=self._TailForever, daemon=True)
+        thread.start()
+
+
+    def _TailForever(self):
+        while True:
+            try:
+                self.CatchUp()
+            except Exception:
+                self.logger.exception("Replica failed to apply the action log")
+            time.sleep(self.poll_interval)
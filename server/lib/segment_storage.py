@@ -0,0 +1,132 @@
+import os
+import gzip
+import json
+import bisect
+from collections import OrderedDict
+
+# Cold tier of the message history: sealed gzip-compressed segment files.
+# Each segment holds a contiguous run of message ids, so the index only keeps
+# the first and last id of every segment. Segments are loaded lazily through a small LRU cache.
+# Cached messages are records with an id attribute and ToJson(), built from json by record_from_json.
+class SegmentStorage:
+
+    index_file_name = "index.json"
+
+    def __init__(self, segments_dir, cache_size, record_from_json, logger):
+        self.segments_dir = segments_dir
+        self.record_from_json = record_from_json
+        self.index_path = os.path.join(segments_dir, SegmentStorage.index_file_name)
+        self.cache_size = cache_size
+        self.logger = logger
+        self.cache = OrderedDict()
+
+        if not os.path.isdir(self.segments_dir):
+            self.logger.info("Segments directory {} does not exist, creating it".format(self.segments_dir))
+            os.makedirs(self.segments_dir)
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as file:
+                self.index = json.load(file)
+        else:
+            self.index = []
+        self.first_ids = [segment["first_id"] for segment in self.index]
+
+
+    def Size(self):
+        if len(self.index) == 0:
+            return 0
+        return self.index[-1]["last_id"] + 1
+
+
+    def Contains(self, message_id):
+        return 0 <= message_id < self.Size()
+
+
+    # Seals every list of messages into its own segment and writes the index once
+    def Seal(self, segments_messages):
+        for messages in segments_messages:
+            assert len(messages) > 0, "Cannot seal an empty segment"
+            assert messages[0].id == self.Size(), "Segments must be sealed in id order"
+            segment = {
+                "first_id": messages[0].id,
+                "last_id": messages[-1].id,
+                "file": "segment_{}.json.gz".format(messages[0].id)
+            }
+            self._WriteSegment(segment, messages)
+            self.index.append(segment)
+            self.first_ids.append(segment["first_id"])
+            self.logger.info("Sealed messages {}..{} into {}".format(segment["first_id"], segment["last_id"], segment["file"]))
+        self._WriteIndex()
+
+
+    def Get(self, message_id):
+        position = self._FindSegment(message_id)
+        segment = self.index[position]
+        return self._LoadCached(position)[message_id - segment["first_id"]]
+
+
+    # Persists a cold message that was changed in place by a comment or reaction
+    def Update(self, message_id):
+        position = self._FindSegment(message_id)
+        self._WriteSegment(self.index[position], self._LoadCached(position))
+
+
+    def GetRange(self, first_id, last_id):
+        result = []
+        if first_id > last_id or not self.Contains(first_id):
+            return result
+        position = self._FindSegment(first_id)
+        while position < len(self.index) and self.index[position]["first_id"] <= last_id:
+            segment = self.index[position]
+            messages = self._LoadCached(position)
+            begin = max(first_id, segment["first_id"]) - segment["first_id"]
+            end = min(last_id, segment["last_id"]) - segment["first_id"] + 1
+            result.extend(messages[begin:end])
+            position += 1
+        return result
+
+
+    # Full scans bypass the cache so that they do not evict the segments hit by reactions
+    def GetAllJson(self):
+        result = []
+        for position, segment in enumerate(self.index):
+            if position in self.cache:
+                result.extend(message.ToJson() for message in self.cache[position])
+            else:
+                result.extend(self._ReadSegmentJson(segment))
+        return result
+
+
+    def _FindSegment(self, message_id):
+        assert self.Contains(message_id), "Message {} is not in cold storage".format(message_id)
+        return bisect.bisect_right(self.first_ids, message_id) - 1
+
+
+    def _LoadCached(self, position):
+        if position in self.cache:
+            self.cache.move_to_end(position)
+            return self.cache[position]
+        messages = [self.record_from_json(message) for message in self._ReadSegmentJson(self.index[position])]
+        self.cache[position] = messages
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return messages
+
+
+    def _ReadSegmentJson(self, segment):
+        self.logger.info("Loading segment {}".format(segment["file"]))
+        with gzip.open(os.path.join(self.segments_dir, segment["file"]), "rt") as file:
+            return json.load(file)
+
+
+    def _WriteSegment(self, segment, messages):
+        path = os.path.join(self.segments_dir, segment["file"])
+        with gzip.open(path + ".tmp", "wt") as file:
+            file.write(json.dumps([message.ToJson() for message in messages]))
+        os.replace(path + ".tmp", path)
+
+
+    def _WriteIndex(self):
+        with open(self.index_path + ".tmp", "w") as file:
+            file.write(json.dumps(self.index))
+        os.replace(self.index_path + ".tmp", self.index_path)
@@ -1,22 +1,118 @@
+import os
+import math
 import argparse
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from lib.data_structures import DataItem, Members, Actions, Messages, supported_reactions
+import json
+import secrets
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from lib.data_structures import DataItem, Members, Actions, Messages, ReadCursors, ParseMessageId, supported_reactions
+from lib.replica import Replica
+from lib.rate_limit import RateLimiter, AdmissionControl, ParseRateLimit
+from lib.profiling import RequestProfiler
 import logging
 from lib.loggers import CreateLogger
 
 members_data_path = "data/members.json"
 messages_data_path = "data/messages.json"
 actions_data_path = "data/actions.json"
+actions_log_path = "data/actions.log"
+segments_data_path = "data/segments"
+cursors_data_path = "data/cursors.json"
+
+messages_hot_window_size = 500
+messages_segment_size = 500
+messages_segment_cache_size = 8
+
+# "tokens per second:burst" per (write kind, "login" or "ip").
+# Many users can share one ip behind a NAT, or run as bots in one process, so ips get larger buckets.
+# Sign ups have no login yet and are limited per ip only.
+default_rate_limits = {
+    ("add_message", "login"): "1:10",
+    ("add_comment", "login"): "1:10",
+    ("add_reaction", "login"): "5:20",
+    ("acknowledge", "login"): "5:20",
+    ("add_message", "ip"): "20:100",
+    ("add_comment", "ip"): "20:100",
+    ("add_reaction", "ip"): "50:200",
+    ("acknowledge", "ip"): "50:200",
+    ("sign_up", "ip"): "1:50"
+}
+default_max_in_flight_writes = 64
+
+profiles_dir = "profiles"
 
 logger_srv = CreateLogger("server", "log/log_server", logging.INFO)
 
-chat_members = Members(logger_srv, members_data_path)
-chat_actions = Actions(logger_srv, actions_data_path)
-chat_messages = Messages(logger_srv, messages_data_path)
+# Opened in main: the primary owns the data files, a replica only reads the primary's action log
+chat_members = None
+chat_actions = None
+chat_messages = None
+chat_cursors = None
+chat_replica = None
+
+chat_rate_limiter = None
+chat_admission = None
+chat_profiler = None
+# Requests are handled in threads, storage is accessed by one of them at a time
+storage_lock = threading.Lock()
+
+
+def open_primary_storage():
+    global chat_members, chat_actions, chat_messages, chat_cursors
+    chat_members = Members(logger_srv, members_data_path)
+    chat_actions = Actions(logger_srv, actions_data_path, actions_log_path)
+    chat_messages = Messages(
+        logger_srv,
+        messages_data_path,
+        segments_data_path,
+        hot_window_size=messages_hot_window_size,
+        segment_size=messages_segment_size,
+        segment_cache_size=messages_segment_cache_size
+    )
+    chat_cursors = ReadCursors(logger_srv, cursors_data_path, chat_actions, chat_messages)
+
+
+def open_replica_storage(primary_data_dir, snapshot_path, poll_interval):
+    global chat_actions, chat_messages, chat_replica
+    chat_replica = Replica(
+        logger_srv,
+        os.path.join(primary_data_dir, os.path.basename(actions_log_path)),
+        snapshot_path=snapshot_path,
+        poll_interval=poll_interval
+    )
+    chat_actions = chat_replica.actions
+    chat_messages = chat_replica.messages
+    chat_replica.Start()
+
+
+def open_admission_control(rate_limits, max_in_flight_writes):
+    global chat_rate_limiter, chat_admission
+    chat_rate_limiter = RateLimiter({bucket_kind: ParseRateLimit(limit) for bucket_kind, limit in rate_limits.items()}, logger_srv)
+    chat_admission = AdmissionControl(max_in_flight_writes, logger_srv)
+
+
+def open_profiler(sample_rate, slow_request_ms):
+    global chat_profiler
+    chat_profiler = RequestProfiler(logger_srv, profiles_dir, sample_rate, slow_request_ms)
+
 
-client_ip_to_login = dict()
+# Header value as an int, None if it is missing or not a number
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Signed in clients identify themselves with the Session header.
+# A login keeps its session across sign ins, so there is at most one session per member.
+session_to_login = dict()
+login_to_session = dict()
 
 class CommentReactionChatServer(BaseHTTPRequestHandler):
+    # Keep-alive connections, so that clients can pipeline requests
+    protocol_version = "HTTP/1.1"
+
     def show_request_debug_info(self, body):
         print("--- Client address --- ", self.client_address)
         print("Path: ", str(self.path))
@@ -26,34 +122,116 @@ class CommentReactionChatServer(BaseHTTPRequestHandler):
 
     def _get_request_body_as_text(self):
         logger_srv.info("Getting request body")
-        content_length = int(self.headers['Content-Length']) 
+        content_length = int(self.headers.get('Content-Length', 0)) 
         post_data = self.rfile.read(content_length)
         body = post_data.decode('utf-8')
         logger_srv.info("Got request body")
         return body
 
 
-    def send_response_code(self, code):
+    def send_response_code(self, code, headers=None, body=""):
+        encoded_body = body.encode('utf-8')
         self.send_response(code)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(encoded_body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
         self.end_headers()
+        self.wfile.write(encoded_body)
+
+
+    def get_login(self):
+        return session_to_login.get(self.headers.get("Session"))
+
+
+    def start_session(self, login):
+        if login not in login_to_session:
+            session = secrets.token_hex(16)
+            login_to_session[login] = session
+            session_to_login[session] = login
+        return login_to_session[login]
 
 
     def do_GET(self):
         if "Get-Chat-State" in self.headers:
             self.handle_get_chat_state() 
+        elif "Get-Chat-Page" in self.headers:
+            first_id, page_size = parse_int(self.headers.get("Page-Start")), parse_int(self.headers.get("Page-Size"))
+            if first_id is None or page_size is None:
+                self.send_response_code(400)
+                return
+            self.handle_get_chat_page(first_id, page_size)
         elif "Get-Chat-Actions" in self.headers:
-            self.handle_get_chat_actions() 
+            first_id = parse_int(self.headers.get("From-Action-ID", 0))
+            if first_id is None:
+                self.send_response_code(400)
+                return
+            self.handle_get_chat_actions(first_id)
+        elif "Get-Chat-Size" in self.headers:
+            self.handle_get_chat_size()
+        elif "Get-Unread" in self.headers:
+            self.handle_get_unread()
+        elif "Get-Unseen-Actions" in self.headers:
+            self.handle_get_unseen_actions()
+        else:
+            self.send_response_code(400)
 
 
     def do_POST(self):
         self.request_body = self._get_request_body_as_text()
         self.show_request_debug_info(self.request_body)
 
+        write_kind = self.get_write_kind()
+        if write_kind is None:
+            with storage_lock:
+                self.dispatch_post()
+            return
+
+        if not self.admit_write(write_kind):
+            return
+        try:
+            with storage_lock:
+                self.dispatch_post()
+        finally:
+            chat_admission.Leave()
+
+
+    def get_write_kind(self):
+        if "Sign-Up" in self.headers:
+            return "sign_up"
+        elif "Send-Message" in self.headers:
+            return "add_message"
+        elif "Comment" in self.headers:
+            return "add_comment"
+        elif "Reaction" in self.headers:
+            return "add_reaction"
+        elif "Ack-Actions" in self.headers:
+            return "acknowledge"
+        return None
+
+
+    # Rate limits and the in-flight cap are checked before any storage work
+    def admit_write(self, write_kind):
+        keys = [("ip", self.client_address[0])]
+        if write_kind != "sign_up" and self.get_login() is not None:
+            keys.append(("login", self.get_login()))
+
+        retry_after = chat_rate_limiter.Check(write_kind, keys)
+        if retry_after > 0:
+            self.send_response_code(429, {"Retry-After": str(math.ceil(retry_after))}) # 429 Too Many Requests
+            return False
+
+        if not chat_admission.TryEnter():
+            self.send_response_code(503, {"Retry-After": "1"}) # 503 Service Unavailable
+            return False
+        return True
+
+
+    def dispatch_post(self):
         if "Auth" in self.headers:
-            self.handle_auth(self.headers["Login"], self.headers["Password"])
+            self.handle_auth(self.headers.get("Login"), self.headers.get("Password"))
         elif "Sign-Up" in self.headers:
-            self.handle_sign_up(self.headers["Login"], self.headers["Password"])
+            self.handle_sign_up(self.headers.get("Login"), self.headers.get("Password"))
         elif "Send-Message" in self.headers:
             self.handle_chat_update("add_message")
         elif "Comment" in self.headers:
@@ -65,14 +243,27 @@ class CommentReactionChatServer(BaseHTTPRequestHandler):
                 self.send_response_code(400)
                 return
             self.handle_chat_update("add_reaction")
+        elif "Ack-Actions" in self.headers:
+            self.handle_ack_actions(parse_int(self.headers.get("Action-ID")))
+        else:
+            self.send_response_code(400)
+
+
+    # Checked before any storage call, so that no half-made member is saved
+    def credentials_missing(self, login, password):
+        if not login or not password:
+            logger_srv.info("Login or password is missing")
+            self.send_response_code(400)
+            return True
+        return False
 
 
     def handle_auth(self, login, password):
+        if self.credentials_missing(login, password):
+            return
         if chat_members.Auth(login, password):
-            self.send_response_code(200)
             welcome_response = "Welcome to Comment-Reaction Chat, {}!".format(login)
-            self.wfile.write(welcome_response.encode('utf-8')) 
-            client_ip_to_login[self.client_address[0]] = login
+            self.send_response_code(200, {"Session": self.start_session(login)}, welcome_response)
             logger_srv.info("Auth with login: {}, password: {} OK!".format(login, password))
             return
         logger_srv.info("Incorrect credentials: login: {}, password: {} !".format(login, password))
@@ -80,6 +271,8 @@ class CommentReactionChatServer(BaseHTTPRequestHandler):
 
 
     def handle_sign_up(self, login, password):
+        if self.credentials_missing(login, password):
+            return
         if chat_members.IsLoginUsed(login):
             logger_srv.info("Registration: login {} is already used!".format(login))
             self.send_response_code(400)
@@ -87,20 +280,29 @@ class CommentReactionChatServer(BaseHTTPRequestHandler):
         item = DataItem("sign_up", login, None, password)
         chat_members.Add(item)
         chat_actions.Add(item)
-        client_ip_to_login[self.client_address[0]] = login
-        self.send_response_code(200)
+        self.send_response_code(200, {"Session": self.start_session(login)})
 
 
     def handle_chat_update(self, action_type):
-        if not self.client_address[0] in client_ip_to_login:
-            print("client_ip_to_login: ", client_ip_to_login, "not found ip: ", self.client_address[0])
+        login = self.get_login()
+        if login is None:
+            print("Unknown session: ", self.headers.get("Session"), "from ip: ", self.client_address[0])
             self.send_response_code(401) # 401 Unauthorized response status code
             return
 
+        if action_type == "add_message":
+            message_id = chat_messages.Size()
+        else:
+            message_id = ParseMessageId(self.headers.get("Message-ID"))
+            if message_id is None:
+                logger_srv.info("Incorrect Message-ID {}".format(self.headers.get("Message-ID")))
+                self.send_response_code(400)
+                return
+
         item = DataItem(
             action_type = action_type, 
-            login = client_ip_to_login[self.client_address[0]], 
-            message_id = chat_messages.Size() if action_type == "add_message" else self.headers["Message-ID"], 
+            login = login, 
+            message_id = message_id, 
             content = self.headers["Reaction"] if action_type == "add_reaction" else self.request_body
         )
         chat_messages.Add(item)
@@ -108,19 +310,158 @@ class CommentReactionChatServer(BaseHTTPRequestHandler):
         self.send_response_code(200)
 
 
+    def handle_ack_actions(self, action_id):
+        login = self.get_login()
+        if login is None:
+            self.send_response_code(401) # 401 Unauthorized response status code
+            return
+        if action_id is None:
+            logger_srv.info("Incorrect Action-ID {}".format(self.headers.get("Action-ID")))
+            self.send_response_code(400)
+            return
+        unread = chat_cursors.Acknowledge(login, action_id)
+        self.send_response_code(200, body=json.dumps(unread))
+
+
     def handle_get_chat_state(self):
         logger_srv.info("Handling get chat state")
-        self.send_response_code(200)
-        self.wfile.write(chat_messages.GetString().encode('utf-8'))
+        with storage_lock:
+            chat_state = chat_messages.GetString()
+        self.send_response_code(200, body=chat_state)
+
+
+    # Chat-Actions tells how many actions the page reflects, so a client can keep it up to date
+    # by applying the actions from that id on
+    def handle_get_chat_page(self, first_id, page_size):
+        logger_srv.info("Handling get chat page: {} messages from {}".format(page_size, first_id))
+        with self.read_lock():
+            chat_page = chat_messages.GetPageString(first_id, page_size)
+            actions_size = chat_actions.Size()
+        self.send_response_code(200, {"Chat-Actions": str(actions_size)}, chat_page)
+
+
+    # Held while messages and actions are read together
+    def read_lock(self):
+        return storage_lock
         
 
-    def handle_get_chat_actions(self):
-        logger_srv.info("Handling get chat actions")
-        self.send_response_code(200)
-        self.wfile.write(chat_actions.GetString().encode('utf-8'))
+    def handle_get_chat_actions(self, first_id):
+        logger_srv.info("Handling get chat actions from {}".format(first_id))
+        with storage_lock:
+            chat_actions_state = chat_actions.GetStringFrom(first_id)
+        self.send_response_code(200, body=chat_actions_state)
+
+
+    def handle_get_chat_size(self):
+        logger_srv.info("Handling get chat size")
+        with storage_lock:
+            chat_size = {"messages": chat_messages.Size(), "actions": chat_actions.Size()}
+        self.send_response_code(200, body=json.dumps(chat_size))
+
+
+    def handle_get_unread(self):
+        logger_srv.info("Handling get unread")
+        login = self.get_login()
+        if login is None:
+            self.send_response_code(401) # 401 Unauthorized response status code
+            return
+        with storage_lock:
+            unread = chat_cursors.Unread(login)
+        self.send_response_code(200, body=json.dumps(unread))
+
+
+    def handle_get_unseen_actions(self):
+        logger_srv.info("Handling get unseen actions")
+        login = self.get_login()
+        if login is None:
+            self.send_response_code(401) # 401 Unauthorized response status code
+            return
+        with storage_lock:
+            unseen = chat_cursors.GetUnseenString(login)
+        self.send_response_code(200, body=unseen)
+
+
+# Serves Get-Chat-State, Get-Chat-Page, Get-Chat-Actions and Get-Chat-Size only,
+# writes and read cursors must go to the primary
+class ReplicaChatServer(CommentReactionChatServer):
+    def send_response_code(self, code, headers=None, body=""):
+        status = chat_replica.Status()
+        replica_headers = {
+            'Replica-Applied-Actions': str(status["applied_actions"]),
+            'Replica-Lag-Bytes': str(status["lag_bytes"]),
+            'Replica-Lag-Seconds': str(status["lag_seconds"])
+        }
+        replica_headers.update(headers or dict())
+        super().send_response_code(code, replica_headers, body)
+
+
+    def do_GET(self):
+        if "Get-Replica-Status" in self.headers:
+            self.handle_get_replica_status()
+        elif "Get-Unread" in self.headers or "Get-Unseen-Actions" in self.headers:
+            self.send_response_code(405) # read cursors are kept by the primary
+        else:
+            super().do_GET()
+
+
+    def do_POST(self):
+        self._get_request_body_as_text()
+        logger_srv.info("Replica does not accept writes, client {}".format(self.client_address))
+        self.send_response_code(405) # 405 Method Not Allowed: writes go to the primary
+
+
+    # The replica applies actions under its own lock, not under storage_lock
+    def read_lock(self):
+        return chat_replica.lock
+
+
+    def handle_get_replica_status(self):
+        logger_srv.info("Handling get replica status")
+        self.send_response_code(200, body=json.dumps(chat_replica.Status()))
+
+
+# Outside of profiling mode only requests with the Profile-Request header reach the profiler,
+# the rest pay for one header lookup
+class ProfilingRequestHandler:
+    route_headers = (
+        "Get-Chat-State", "Get-Chat-Page", "Get-Chat-Actions", "Get-Chat-Size", "Get-Unread",
+        "Get-Unseen-Actions", "Get-Replica-Status", "Auth", "Sign-Up", "Send-Message", "Comment",
+        "Reaction", "Ack-Actions"
+    )
+
+    def do_GET(self):
+        self.run_profiled(super().do_GET)
 
 
-def run(server_class=HTTPServer, handler_class=CommentReactionChatServer, addr="localhost", port=19000):
+    def do_POST(self):
+        self.run_profiled(super().do_POST)
+
+
+    def run_profiled(self, handle):
+        profile_requested = self.profile_requested()
+        if chat_profiler.watches_all or profile_requested:
+            chat_profiler.Run(self.get_route(), handle, profile_requested)
+        else:
+            handle()
+
+
+    def get_route(self):
+        for header in ProfilingRequestHandler.route_headers:
+            if header in self.headers:
+                return "{}-{}".format(self.command, header)
+        return self.command
+
+
+    # The Profile-Request header is honoured for local clients only
+    def profile_requested(self):
+        return "Profile-Request" in self.headers and self.client_address[0] in ("127.0.0.1", "::1")
+
+
+def profiled_handler_class(handler_class):
+    return type("Profiled" + handler_class.__name__, (ProfilingRequestHandler, handler_class), dict())
+
+
+def run(server_class=ThreadingHTTPServer, handler_class=CommentReactionChatServer, addr="localhost", port=19000):
     server_address = (addr, port)
     httpd = server_class(server_address, handler_class)
 
@@ -144,6 +485,75 @@ if __name__ == "__main__":
         default=19000,
         help="Specify the port on which the server listens",
     )
+    parser.add_argument(
+        "--replica",
+        action="store_true",
+        help="Run as a read replica that tails the primary's action log",
+    )
+    parser.add_argument(
+        "--primary-data",
+        default="data",
+        help="Data directory of the primary (replica mode)",
+    )
+    parser.add_argument(
+        "--snapshot",
+        default=None,
+        help="Copy of the primary's actions.json to start from instead of replaying the whole log (replica mode)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.1,
+        help="How often, in seconds, the replica checks the action log for new actions (replica mode)",
+    )
+    rate_flags = {"add_message": "message-rate", "add_comment": "comment-rate", "add_reaction": "reaction-rate",
+                  "sign_up": "sign-up-rate", "acknowledge": "ack-rate"}
+    for write_kind, key_type in default_rate_limits:
+        parser.add_argument(
+            "--{}{}".format("ip-" if key_type == "ip" else "", rate_flags[write_kind]),
+            dest="{}_{}".format(key_type, write_kind),
+            metavar="RATE:BURST",
+            default=default_rate_limits[(write_kind, key_type)],
+            help="Token bucket for {} per {}, as 'tokens per second:burst' (default {})"
+                .format(write_kind, key_type, default_rate_limits[(write_kind, key_type)]),
+        )
+    parser.add_argument(
+        "--max-in-flight-writes",
+        type=int,
+        default=default_max_in_flight_writes,
+        help="Writes above this number being processed at once are answered with 503",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile sampled requests and warn about slow requests. Requests with the Profile-Request header from localhost are profiled either way",
+    )
+    parser.add_argument(
+        "--profile-sample-rate",
+        type=float,
+        default=0.01,
+        help="Share of requests to profile in profiling mode",
+    )
+    parser.add_argument(
+        "--slow-request-ms",
+        type=float,
+        default=200,
+        help="Requests slower than this are logged with a stack breakdown in profiling mode",
+    )
     args = parser.parse_args()
-    run(addr=args.listen, port=args.port)
+    handler_class = ReplicaChatServer if args.replica else CommentReactionChatServer
+    if args.profile:
+        open_profiler(args.profile_sample_rate, args.slow_request_ms)
+    else:
+        open_profiler(0, None)
+    handler_class = profiled_handler_class(handler_class)
+    open_admission_control(
+        {(write_kind, key_type): getattr(args, "{}_{}".format(key_type, write_kind)) for write_kind, key_type in default_rate_limits},
+        args.max_in_flight_writes
+    )
+    if args.replica:
+        open_replica_storage(args.primary_data, args.snapshot, args.poll_interval)
+    else:
+        open_primary_storage()
+    run(handler_class=handler_class, addr=args.listen, port=args.port)
 
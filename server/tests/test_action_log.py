@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import logging
+from lib.action_log import ActionLog, ActionLogTailer
+from lib.replica import Replica
+
+
+def write_log(tmp_path, count):
+    log = ActionLog(str(tmp_path / "actions.log"), logging.getLogger("test"))
+    actions = [{"id": action_id, "action_type": "add_message", "login": "login", "message_id": action_id, "content": "text {}".format(action_id)}
+               for action_id in range(count)]
+    log.Backfill(actions)
+    return actions
+
+
+def test_tailer_reads_in_chunks_and_waits_for_complete_lines(tmp_path):
+    write_log(tmp_path, 10)
+    with open(tmp_path / "actions.log", "a") as file:
+        file.write('{"id": 10, "action_type"')
+    tailer = ActionLogTailer(str(tmp_path / "actions.log"), logging.getLogger("test"), max_read_bytes=100)
+
+    read_ids = []
+    while True:
+        actions = tailer.ReadNew()
+        if len(actions) == 0:
+            break
+        assert len(actions) < 10
+        read_ids.extend(action["id"] for action in actions)
+    assert read_ids == list(range(10))
+    assert tailer.BytesBehind() == len('{"id": 10, "action_type"')
+
+
+def test_tailer_skips_lines_across_chunks(tmp_path):
+    write_log(tmp_path, 10)
+    for count in (0, 3, 9, 10, 15):
+        tailer = ActionLogTailer(str(tmp_path / "actions.log"), logging.getLogger("test"), max_read_bytes=50)
+        tailer.SkipLines(count)
+        assert [action["id"] for action in tailer.ReadNew()][:1] == ([min(count, 10)] if count < 10 else [])
+
+
+def test_replica_starts_from_snapshot(tmp_path):
+    actions = write_log(tmp_path, 10)
+    with open(tmp_path / "snapshot.json", "w") as file:
+        json.dump(actions[:6], file)
+    replica = Replica(logging.getLogger("test"), str(tmp_path / "actions.log"), str(tmp_path / "snapshot.json"))
+    assert replica.Status() == {"applied_actions": 10, "lag_bytes": 0, "lag_seconds": 0.0}
+    assert replica.messages.Size() == 10
+
+
+def test_replica_lag_is_the_age_of_the_first_unapplied_action(tmp_path):
+    write_log(tmp_path, 3)
+    replica = Replica(logging.getLogger("test"), str(tmp_path / "actions.log"))
+    # The primary has been idle for a while
+    idle_since = time.time() - 30
+    os.utime(tmp_path / "actions.log", (idle_since, idle_since))
+    replica.CatchUp()
+
+    log = ActionLog(str(tmp_path / "actions.log"), logging.getLogger("test"))
+    log.Append({"id": 3, "action_type": "add_message", "login": "login", "message_id": 3, "content": "text 3"})
+    assert replica.tailer.BytesBehind() > 0
+    assert replica.LagSeconds() < 1
+
+    replica.CatchUp()
+    assert replica.Status() == {"applied_actions": 4, "lag_bytes": 0, "lag_seconds": 0.0}
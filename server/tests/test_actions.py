@@ -0,0 +1,59 @@
+import json
+import logging
+import pytest
+from lib.data_structures import DataItem, Actions, ActionColumns, ParseMessageId
+
+
+def test_message_id_must_fit_the_column():
+    assert ParseMessageId("42") == 42
+    assert ParseMessageId("-1") == -1
+    assert ParseMessageId("abc") is None
+    assert ParseMessageId(None) is None
+    assert ParseMessageId(str(2 ** 63)) is None
+    assert ParseMessageId(str(-(2 ** 63))) is None
+
+
+def test_rejected_action_leaves_columns_intact():
+    columns = ActionColumns()
+    columns.Append("add_message", "login", 0, "text")
+    with pytest.raises(ValueError):
+        columns.Append("add_comment", "login", "99999999999999999999", "comment")
+    columns.Append("add_reaction", "login", "0", "Fire")
+    assert [action["id"] for action in json.loads(columns.GetString())] == [0, 1]
+
+
+def open_actions(tmp_path):
+    return Actions(logging.getLogger("test"), str(tmp_path / "actions.json"), str(tmp_path / "actions.log"))
+
+
+def log_ids(tmp_path):
+    with open(tmp_path / "actions.log", "r") as file:
+        return [json.loads(line)["id"] for line in file]
+
+
+def test_log_is_the_record_of_actions(tmp_path):
+    actions = open_actions(tmp_path)
+    actions.Add(DataItem("sign_up", "login", None, "password"))
+    actions.Add(DataItem("add_message", "login", 0, "text"))
+    # Written on start only
+    assert json.loads((tmp_path / "actions.json").read_text()) == []
+
+    # The primary died after logging an action, in the middle of logging the next one
+    with open(tmp_path / "actions.log", "a") as file:
+        file.write(json.dumps({"id": 2, "action_type": "add_message", "login": "login", "message_id": 1, "content": "text"}) + "\n")
+        file.write('{"id": 3, "action_')
+    actions = open_actions(tmp_path)
+    assert actions.Size() == 3
+    assert [action["id"] for action in json.loads((tmp_path / "actions.json").read_text())] == [0, 1, 2]
+
+    actions.Add(DataItem("add_reaction", "login", 0, "Fire"))
+    assert log_ids(tmp_path) == [0, 1, 2, 3]
+
+
+def test_log_is_backfilled_from_older_history(tmp_path):
+    history = [{"id": 0, "action_type": "sign_up", "login": "login", "message_id": None, "content": "password"}]
+    (tmp_path / "actions.json").write_text(json.dumps(history))
+    actions = open_actions(tmp_path)
+    actions.Add(DataItem("add_message", "login", 0, "text"))
+    assert log_ids(tmp_path) == [0, 1]
+    assert json.loads(actions.GetString())[0] == history[0]
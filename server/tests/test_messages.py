@@ -0,0 +1,32 @@
+import json
+import logging
+from lib.data_structures import DataItem, Messages
+
+
+def open_messages(tmp_path):
+    return Messages(
+        logging.getLogger("test"),
+        str(tmp_path / "messages.json"),
+        str(tmp_path / "segments"),
+        hot_window_size=3,
+        segment_size=2,
+        segment_cache_size=1
+    )
+
+
+def page_ids(messages, first_id, page_size):
+    return [message["id"] for message in json.loads(messages.GetPageString(first_id, page_size))]
+
+
+def test_page_over_cold_and_hot_messages(tmp_path):
+    messages = open_messages(tmp_path)
+    for message_id in range(10):
+        messages.Add(DataItem("add_message", "login", message_id, "text {}".format(message_id)))
+    assert messages.hot_first_id == 6
+
+    assert page_ids(messages, 0, 3) == [0, 1, 2]
+    assert page_ids(messages, 4, 4) == [4, 5, 6, 7]
+    assert page_ids(messages, 7, 10) == [7, 8, 9]
+    assert page_ids(messages, 3, 0) == []
+    assert page_ids(messages, 3, -1) == []
+    assert page_ids(messages, 12, 3) == []
@@ -0,0 +1,50 @@
+import os
+import time
+import logging
+import threading
+from lib.profiling import RequestProfiler
+
+logger = logging.getLogger("test_profiling")
+
+
+def test_forced_request_is_profiled_without_sampling(tmp_path):
+    profiles_dir = str(tmp_path / "profiles")
+    profiler = RequestProfiler(logger, profiles_dir, 0, None)
+    assert not profiler.watches_all
+    profiler.Run("GET-Get-Chat-Page", lambda: sum(range(1000)))
+    assert not os.path.isdir(profiles_dir)
+
+    profiler.Run("GET-Get-Chat-Page", lambda: sum(range(1000)), force_profile=True)
+    names = os.listdir(profiles_dir)
+    assert sorted(name.rsplit(".", 1)[1] for name in names) == ["prof", "tracemalloc"]
+    assert all(name.split("_", 1)[1].startswith("GET-Get-Chat-Page_") for name in names)
+
+
+def slow_handler():
+    time.sleep(0.2)
+
+
+def test_slow_request_is_logged_with_its_stack(tmp_path, caplog):
+    profiler = RequestProfiler(logger, str(tmp_path / "profiles"), 0, 20)
+    with caplog.at_level(logging.WARNING, logger="test_profiling"):
+        profiler.Run("POST-Send-Message", slow_handler)
+        profiler.Run("POST-Comment", lambda: None)
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert message.startswith("Slow request POST-Send-Message")
+    assert "Stack after 20 ms" in message
+    assert "in slow_handler" in message
+
+
+def test_one_watchdog_thread_for_all_requests(tmp_path):
+    profiler = RequestProfiler(logger, str(tmp_path / "profiles"), 0, 1000)
+    profiler.Run("GET", lambda: None)
+    threads = threading.active_count()
+    requests = [threading.Thread(target=profiler.Run, args=("GET", slow_handler)) for _ in range(5)]
+    for request in requests:
+        request.start()
+    time.sleep(0.1)
+    assert threading.active_count() == threads + len(requests)
+    for request in requests:
+        request.join()
+    assert len(profiler.watched) == 0
@@ -0,0 +1,34 @@
+import logging
+from lib.rate_limit import RateLimiter, AdmissionControl, ParseRateLimit, max_wait_time
+
+
+def test_zero_rate_gives_finite_wait_time():
+    limiter = RateLimiter({("sign_up", "ip"): ParseRateLimit("0:1")}, logging.getLogger("test"))
+    assert limiter.Check("sign_up", [("ip", "127.0.0.1")]) == 0
+    assert limiter.Check("sign_up", [("ip", "127.0.0.1")]) == max_wait_time
+
+
+def test_request_takes_tokens_from_all_keys_or_none():
+    limiter = RateLimiter({("add_reaction", "ip"): ParseRateLimit("0:1"), ("add_reaction", "login"): ParseRateLimit("0:1")},
+                          logging.getLogger("test"))
+    assert limiter.Check("add_reaction", [("ip", "1"), ("login", "a")]) == 0
+    assert limiter.Check("add_reaction", [("ip", "2"), ("login", "a")]) > 0
+    assert limiter.Check("add_reaction", [("ip", "2"), ("login", "b")]) == 0
+
+
+def test_users_behind_one_ip_have_their_own_budget():
+    limiter = RateLimiter({("add_message", "ip"): ParseRateLimit("0:4"), ("add_message", "login"): ParseRateLimit("0:1")},
+                          logging.getLogger("test"))
+    for login in ("a", "b", "c", "d"):
+        assert limiter.Check("add_message", [("ip", "nat"), ("login", login)]) == 0
+        assert limiter.Check("add_message", [("ip", "nat"), ("login", login)]) > 0
+    assert limiter.Check("add_message", [("ip", "nat"), ("login", "e")]) > 0
+    assert limiter.Check("add_message", [("ip", "other"), ("login", "e")]) == 0
+
+
+def test_admission_control_caps_writes_in_flight():
+    admission = AdmissionControl(2, logging.getLogger("test"))
+    assert admission.TryEnter() and admission.TryEnter()
+    assert not admission.TryEnter()
+    admission.Leave()
+    assert admission.TryEnter()
@@ -0,0 +1,68 @@
+import logging
+from lib.data_structures import DataItem, Actions, Messages, ReadCursors
+
+
+def open_cursors(tmp_path):
+    logger = logging.getLogger("test")
+    actions = Actions(logger, str(tmp_path / "actions.json"), str(tmp_path / "actions.log"))
+    messages = Messages(logger, str(tmp_path / "messages.json"), str(tmp_path / "segments"))
+    return actions, messages, ReadCursors(logger, str(tmp_path / "cursors.json"), actions, messages)
+
+
+def add(actions, messages, action_type, login, message_id, content):
+    item = DataItem(action_type, login, message_id, content)
+    messages.Add(item)
+    actions.Add(item)
+
+
+def test_own_actions_are_not_unread(tmp_path):
+    actions, messages, cursors = open_cursors(tmp_path)
+    add(actions, messages, "sign_up", "a", None, "password")
+    add(actions, messages, "sign_up", "b", None, "password")
+    assert cursors.Unread("a")["unread"] == 1
+
+    add(actions, messages, "add_message", "a", 0, "hi @b")
+    add(actions, messages, "add_comment", "b", 0, "hi @a")
+    add(actions, messages, "add_message", "a", 1, "bye")
+    assert cursors.Unread("a") == {"cursor": 0, "unread": 2, "mentions": 1, "replies": 1}
+    assert cursors.Unread("b") == {"cursor": 1, "unread": 2, "mentions": 1, "replies": 0}
+
+    assert cursors.Acknowledge("a", 2)["unread"] == 1
+    assert cursors.Acknowledge("a", 100) == {"cursor": 4, "unread": 0, "mentions": 0, "replies": 0}
+
+
+def test_counts_survive_restart(tmp_path):
+    actions, messages, cursors = open_cursors(tmp_path)
+    add(actions, messages, "sign_up", "a", None, "password")
+    add(actions, messages, "sign_up", "b", None, "password")
+    add(actions, messages, "add_message", "b", 0, "hi @a")
+    cursors.Acknowledge("a", 0)
+    add(actions, messages, "add_message", "a", 1, "hi")
+
+    actions, messages, cursors = open_cursors(tmp_path)
+    assert cursors.Unread("a") == {"cursor": 0, "unread": 2, "mentions": 1, "replies": 0}
+
+
+def test_first_query_does_not_replay_history(tmp_path, monkeypatch):
+    actions, messages, cursors = open_cursors(tmp_path)
+    add(actions, messages, "sign_up", "old", None, "password")
+    for message_id in range(300):
+        add(actions, messages, "add_message", "old", message_id, "text {}".format(message_id))
+    add(actions, messages, "sign_up", "a", None, "password")
+    add(actions, messages, "add_comment", "old", 0, "hi @a")
+    add(actions, messages, "add_message", "a", 300, "hi")
+
+    monkeypatch.setattr(ReadCursors, "Scan", None)
+    assert cursors.Unread("a") == {"cursor": 301, "unread": 1, "mentions": 1, "replies": 0}
+    assert cursors.Unread("old") == {"cursor": 0, "unread": 2, "mentions": 0, "replies": 0}
+
+
+def test_members_from_before_cursors_have_seen_everything(tmp_path):
+    actions, messages, cursors = open_cursors(tmp_path)
+    add(actions, messages, "sign_up", "a", None, "password")
+    add(actions, messages, "add_message", "a", 0, "hi")
+    (tmp_path / "cursors.json").write_text("{}")
+
+    actions, messages, cursors = open_cursors(tmp_path)
+    add(actions, messages, "add_message", "b", 1, "hi @a")
+    assert cursors.Unread("a") == {"cursor": 1, "unread": 1, "mentions": 1, "replies": 0}
@@ -0,0 +1,82 @@
+import os
+import time
+import threading
+import http.client
+import importlib
+from http.server import ThreadingHTTPServer
+import pytest
+
+
+@pytest.fixture
+def chat_server(tmp_path, monkeypatch):
+    # The server keeps its data and logs next to the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    os.makedirs("log")
+    server = importlib.import_module("server")
+    server.open_primary_storage()
+    server.session_to_login.clear()
+    server.login_to_session.clear()
+    # As started without --profile
+    server.open_profiler(0, None)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.profiled_handler_class(server.CommentReactionChatServer))
+    threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    yield server, httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(port, headers, body=""):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.request("POST", "/", headers=headers, body=body)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response
+
+
+def test_rate_limited_write_gets_429_with_retry_after(chat_server):
+    server, port = chat_server
+    server.open_admission_control({("sign_up", "ip"): "1:50", ("add_message", "login"): "0.1:1"}, 64)
+    session = post(port, {"Sign-Up": "true", "Login": "a", "Password": "pa"}).getheader("Session")
+
+    assert post(port, {"Send-Message": "true", "Session": session}, "first").status == 200
+    response = post(port, {"Send-Message": "true", "Session": session}, "second")
+    assert response.status == 429
+    assert response.getheader("Retry-After") == "10"
+    assert server.chat_messages.Size() == 1
+
+
+def test_zero_rate_gets_429_instead_of_a_dropped_connection(chat_server):
+    server, port = chat_server
+    server.open_admission_control({("sign_up", "ip"): "0:1"}, 64)
+    assert post(port, {"Sign-Up": "true", "Login": "a", "Password": "pa"}).status == 200
+    response = post(port, {"Sign-Up": "true", "Login": "b", "Password": "pb"})
+    assert response.status == 429
+    assert response.getheader("Retry-After") == "3600"
+
+
+def test_write_over_the_in_flight_cap_gets_503(chat_server):
+    server, port = chat_server
+    server.open_admission_control(dict(), 1)
+    assert server.chat_admission.TryEnter() # a write that is still being processed
+    response = post(port, {"Sign-Up": "true", "Login": "a", "Password": "pa"})
+    assert response.status == 503
+    assert response.getheader("Retry-After") == "1"
+    server.chat_admission.Leave()
+    assert post(port, {"Sign-Up": "true", "Login": "a", "Password": "pa"}).status == 200
+
+
+def test_profile_request_header_is_honoured_without_profiling_mode(chat_server):
+    server, port = chat_server
+    server.open_admission_control({("sign_up", "ip"): "1:50"}, 64)
+    assert post(port, {"Sign-Up": "true", "Login": "a", "Password": "pa"}).status == 200
+    assert not os.path.isdir("profiles")
+
+    assert post(port, {"Sign-Up": "true", "Login": "b", "Password": "pb", "Profile-Request": "true"}).status == 200
+    # The profile is saved after the response has been sent
+    deadline = time.monotonic() + 5
+    while len(os.listdir("profiles") if os.path.isdir("profiles") else []) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(name.rsplit(".", 1)[1] for name in os.listdir("profiles")) == ["prof", "tracemalloc"]
+    assert "POST-Sign-Up" in os.listdir("profiles")[0]